@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Runs the load test twice, once polling each order and once reconciling
+# from the request history, and compares upstream calls per delivered OTP.
+#
+#   python bench/compare_reconcile.py --rate 10 --duration 60
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(mode, extra):
+    out = os.path.join(tempfile.mkdtemp(prefix=f"okvip-{mode}-"), "report.json")
+    args = [sys.executable, os.path.join(HERE, "run.py"), "--out", out] + extra
+    if mode == "reconcile":
+        args.append("--reconcile")
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+    with open(out, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    extra = sys.argv[1:]
+    rows = []
+    for mode in ("poll", "reconcile"):
+        report = run(mode, extra)
+        rows.append((mode, report))
+    print(f"{'mode':<10} {'otps':>5} {'calls':>7} {'calls/otp':>10} {'otp p50':>8} {'otp p99':>8}  breakdown")
+    for mode, report in rows:
+        calls = report["upstream_calls"]
+        print(f"{mode:<10} {report['tap_to_otp']['count']:>5} {sum(calls.values()):>7} "
+              f"{report['upstream_calls_per_otp'] or '-':>10} {report['tap_to_otp']['p50'] or '-':>8} "
+              f"{report['tap_to_otp']['p99'] or '-':>8}  {json.dumps(calls, sort_keys=True)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class QuietServer(ThreadingHTTPServer):
+    # Keep-alive clients going away (the bot being stopped) is not an error.
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeTelegram:
+    # Records every Bot API call the bot makes and answers with just enough
+    # of a response for telebot to be happy.
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = Counter()
+        self.events = []
+        self.by_chat = defaultdict(list)
+        self.webhook = {"url": "", "has_custom_certificate": False, "max_connections": 40,
+                        "pending_update_count": 0}
+        self._message_ids = itertools.count(1000)
+        self._cond = threading.Condition()
+        self._server = None
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        event = {"t": time.monotonic(), "method": method, "params": params}
+        if method in ("sendMessage", "editMessageText"):
+            event["chat_id"] = int(params.get("chat_id", 0))
+            event["message_id"] = int(params.get("message_id") or next(self._message_ids))
+        with self._cond:
+            self.calls[method] += 1
+            self.events.append(event)
+            if "chat_id" in event:
+                self.by_chat[event["chat_id"]].append(event)
+            self._cond.notify_all()
+        if "chat_id" in event:
+            return {
+                "message_id": event["message_id"],
+                "date": int(time.time()),
+                "chat": {"id": event["chat_id"], "type": "private"},
+                "text": params.get("text", ""),
+            }
+        if method == "getWebhookInfo":
+            return dict(self.webhook)
+        if method == "setWebhook":
+            self.webhook["url"] = params.get("url", "")
+            self.webhook["max_connections"] = int(params.get("max_connections", 40))
+            allowed = params.get("allowed_updates")
+            self.webhook["allowed_updates"] = json.loads(allowed) if isinstance(allowed, str) else allowed
+            return True
+        if method == "deleteWebhook":
+            self.webhook["url"] = ""
+            return True
+        if method == "getUpdates":
+            return []
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        return True
+
+    def wait_for(self, chat_id, predicate, timeout):
+        # Returns the first send/edit to chat_id matching predicate.
+        deadline = time.monotonic() + timeout
+        index = 0
+        with self._cond:
+            while True:
+                events = self.by_chat.get(chat_id, ())
+                while index < len(events):
+                    event = events[index]
+                    index += 1
+                    if predicate(event):
+                        return event
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def stats(self):
+        with self._cond:
+            return {"calls": dict(self.calls)}
+
+    def serve(self, host="127.0.0.1", port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive like the real APIs, so connection reuse shows up.
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def _reply(self, params):
+                method = urlparse(self.path).path.rsplit('/', 1)[-1]
+                result = fake.handle(method, params)
+                data = json.dumps({"ok": True, "result": result}).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                query = urlparse(self.path).query
+                self._reply({k: v[-1] for k, v in parse_qs(query).items()})
+
+            def do_POST(self):
+                params = {k: v[-1] for k, v in parse_qs(urlparse(self.path).query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ""
+                if body and self.headers.get("Content-Type", "").startswith("application/json"):
+                    params.update(json.loads(body))
+                elif body:
+                    params.update({k: v[-1] for k, v in parse_qs(body).items()})
+                self._reply(params)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = QuietServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-telegram", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import hmac
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+
+
+class QuietServer(ThreadingHTTPServer):
+    # Keep-alive clients going away (the bot being stopped) is not an error.
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeViotp:
+    # Stand-in for https://api.viotp.com with tunable latency, stock-outs and
+    # OTP arrival times (log-normal around otp_median seconds). With a
+    # callback_url it also pushes each OTP there, signed with callback_secret,
+    # dropping a push_loss fraction so the polling fallback gets exercised.
+    def __init__(self, latency=0.15, jitter=0.05, out_of_stock=0.0, otp_median=20.0,
+                 otp_sigma=0.4, no_otp=0.0, expire=300.0, balance=1000.0, seed=None,
+                 callback_url=None, callback_secret="", push_loss=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.out_of_stock = out_of_stock
+        self.otp_median = otp_median
+        self.otp_sigma = otp_sigma
+        self.no_otp = no_otp
+        self.expire = expire
+        self.balance = balance
+        self.random = random.Random(seed)
+        self.callback_url = callback_url
+        self.callback_secret = callback_secret
+        self.push_loss = push_loss
+        self.pushes = Counter()
+        self.calls = Counter()
+        self.orders = {}
+        self._ids = iter(range(100000, 10 ** 9))
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _sleep(self):
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, endpoint, params):
+        with self._lock:
+            self.calls[endpoint] += 1
+        self._sleep()
+        if endpoint == "users/balance":
+            return {"status_code": 200, "data": {"balance": self.balance}}
+        if endpoint == "request/getv2":
+            return self._request(params)
+        if endpoint == "session/getv2":
+            return self._session(params.get("requestId"))
+        if endpoint == "session/historyv2":
+            return self._history(int(params.get("limit", 100)), int(params.get("page", 1)))
+        return {"status_code": 404, "message": "not found"}
+
+    def _request(self, params):
+        with self._lock:
+            if self.random.random() < self.out_of_stock:
+                return {"status_code": -3, "message": "Kho số tạm hết"}
+            request_id = next(self._ids)
+            arrives = None
+            if self.random.random() >= self.no_otp:
+                arrives = time.time() + self.random.lognormvariate(0, self.otp_sigma) * self.otp_median
+            self.orders[str(request_id)] = {
+                "created": time.time(),
+                "arrives": arrives,
+                "service": params.get("serviceId"),
+                "network": params.get("network", "any"),
+                "code": f"{self.random.randint(0, 999999):06d}",
+            }
+            self.balance -= 0.1
+            if self.callback_url and arrives is not None and self.random.random() >= self.push_loss:
+                timer = threading.Timer(arrives - time.time(), self._push, (request_id,))
+                timer.daemon = True
+                timer.start()
+            return {"status_code": 200, "data": {
+                "request_id": request_id,
+                "phone_number": f"09{request_id % 10 ** 8:08d}",
+                "balance": round(self.balance, 2),
+            }}
+
+    def _state(self, order):
+        now = time.time()
+        if order["arrives"] is not None and now >= order["arrives"]:
+            return {"Status": 1, "Code": order["code"], "IsSound": "false"}
+        if now - order["created"] >= self.expire:
+            return {"Status": 2}
+        return {"Status": 0}
+
+    def _session(self, request_id):
+        order = self.orders.get(str(request_id))
+        if order is None:
+            return {"status_code": -1, "message": "Không tìm thấy đơn"}
+        return {"status_code": 200, "data": self._state(order)}
+
+    def _history(self, limit, page):
+        # Newest first, like the account history in the real API.
+        with self._lock:
+            ids = sorted(self.orders, key=int, reverse=True)[(page - 1) * limit:page * limit]
+            items = [dict(self._state(self.orders[i]), RequestId=int(i)) for i in ids]
+        return {"status_code": 200, "data": items}
+
+    def _push(self, request_id):
+        order = self.orders[str(request_id)]
+        body = json.dumps({"RequestId": request_id, "Status": 1, "Code": order["code"],
+                           "IsSound": "false"}).encode('utf-8')
+        signature = hmac.new(self.callback_secret.encode(), body, hashlib.sha256).hexdigest()
+        request = Request(self.callback_url, data=body, method="POST", headers={
+            "Content-Type": "application/json", "X-Signature": f"sha256={signature}"})
+        try:
+            with urlopen(request, timeout=10) as response:
+                outcome = json.loads(response.read()).get("outcome", "ok")
+        except Exception:
+            outcome = "error"
+        with self._lock:
+            self.pushes[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "orders": len(self.orders), "pushes": dict(self.pushes)}
+
+    def serve(self, host="127.0.0.1", port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive like the real APIs, so connection reuse shows up.
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                if url.path == "/_stats":
+                    body = fake.stats()
+                else:
+                    body = fake.handle(url.path.strip('/'), params)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = QuietServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-viotp", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Local fake viotp API")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.15)
+    parser.add_argument("--out-of-stock", type=float, default=0.0)
+    parser.add_argument("--otp-median", type=float, default=20.0)
+    args = parser.parse_args()
+    fake = FakeViotp(latency=args.latency, out_of_stock=args.out_of_stock, otp_median=args.otp_median)
+    print(fake.serve(port=args.port), flush=True)
+    while True:
+        time.sleep(3600)
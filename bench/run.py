@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# Offline load test: starts the fake viotp and Telegram servers, runs buy.py
+# against them and replays synthetic users through the webhook.
+#
+#   python bench/run.py --rate 10 --duration 60 --out results.json
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from fake_telegram import FakeTelegram
+from fake_viotp import FakeViotp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:bench"
+SERVICE_BUTTONS = ["📱 OKVIP1", "📱 OKVIP2"]
+NUMBER_OK = "THUÊ THÀNH CÔNG"
+NUMBER_FAILED = "THUÊ SỐ THẤT BẠI"
+OTP_OK = "OTP ĐÃ VỀ"
+OTP_TIMEOUT = "HẾT THỜI GIAN"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 3)
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p99": percentile(values, 0.99),
+        "mean": round(sum(values) / len(values), 3) if values else None,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+class ProcessSampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.threads = []
+        self.rss_kb = []
+        self._stop = threading.Event()
+
+    def _read(self):
+        values = {}
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Threads", "VmRSS"):
+                    values[key] = int(value.split()[0])
+        return values
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                values = self._read()
+            except OSError:
+                return
+            self.threads.append(values.get("Threads", 0))
+            self.rss_kb.append(values.get("VmRSS", 0))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class Harness:
+    def __init__(self, args, bot_url, telegram):
+        self.args = args
+        self.bot_url = bot_url
+        self.telegram = telegram
+        self.http = requests.Session()
+        self.http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.users_in_flight))
+        self.random = random.Random(args.seed)
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.lock = threading.Lock()
+
+    def post(self, update):
+        with self.lock:
+            update["update_id"] = next(self.update_ids)
+        self.http.post(self.bot_url, json=update, timeout=30)
+
+    def user(self, index):
+        chat_id = 10 ** 7 + index
+        sender = {"id": chat_id, "is_bot": False, "first_name": f"bench{index}"}
+        chat = {"id": chat_id, "type": "private"}
+        result = {"chat_id": chat_id}
+        self.post({"message": {
+            "message_id": 1, "date": int(time.time()), "chat": chat, "from": sender,
+            "text": self.random.choice(SERVICE_BUTTONS),
+        }})
+        menu = self.telegram.wait_for(
+            chat_id, lambda e: e["method"] == "sendMessage" and "reply_markup" in e["params"], 30)
+        if menu is None:
+            result["error"] = "no network keyboard"
+            return result
+        markup = menu["params"]["reply_markup"]
+        if isinstance(markup, str):
+            # telebot sends it as a JSON string, async mode as a JSON object.
+            markup = json.loads(markup)
+        buttons = [b for row in markup["inline_keyboard"] for b in row if "callback_data" in b]
+        if self.args.network:
+            buttons = [b for b in buttons if self.args.network.lower() in b["text"].lower()] or buttons
+        button = self.random.choice(buttons)
+
+        tapped = time.monotonic()
+        self.post({"callback_query": {
+            "id": str(chat_id), "from": sender, "chat_instance": str(chat_id),
+            "data": button["callback_data"],
+            "message": {"message_id": menu["message_id"], "date": int(time.time()), "chat": chat,
+                        "from": {"id": 1, "is_bot": True, "first_name": "Fake"}, "text": "menu"},
+        }})
+        number = self.telegram.wait_for(
+            chat_id, lambda e: NUMBER_OK in e["params"].get("text", "") or NUMBER_FAILED in e["params"].get("text", ""),
+            60)
+        if number is None:
+            result["error"] = "no number"
+            return result
+        if NUMBER_FAILED in number["params"]["text"]:
+            result["error"] = "rent failed"
+            return result
+        result["tap_to_number"] = number["t"] - tapped
+        otp = self.telegram.wait_for(
+            chat_id, lambda e: OTP_OK in e["params"].get("text", "") or OTP_TIMEOUT in e["params"].get("text", ""),
+            self.args.otp_wait)
+        if otp is None:
+            result["error"] = "no otp"
+        elif OTP_OK in otp["params"]["text"]:
+            result["tap_to_otp"] = otp["t"] - tapped
+        else:
+            result["error"] = "otp timeout"
+        return result
+
+    def run(self):
+        total = int(self.args.rate * self.args.duration)
+        futures = []
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.users_in_flight) as pool:
+            for i in range(total):
+                delay = started + i / self.args.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(self.user, i))
+            results = [f.result() for f in futures]
+        return results, time.monotonic() - started
+
+
+def wait_healthy(url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"bot exited with code {proc.returncode}")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("bot did not become healthy")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the OKVIP bot")
+    parser.add_argument("--rate", type=float, default=5, help="new users per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep adding users")
+    parser.add_argument("--users-in-flight", type=int, default=500)
+    parser.add_argument("--network", default=None, help="only tap networks whose button mentions this name")
+    parser.add_argument("--viotp-latency", type=float, default=0.15)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--out-of-stock", type=float, default=0.0)
+    parser.add_argument("--otp-median", type=float, default=15.0)
+    parser.add_argument("--otp-sigma", type=float, default=0.4)
+    parser.add_argument("--no-otp", type=float, default=0.0)
+    parser.add_argument("--otp-wait", type=float, default=120, help="seconds a user waits for the OTP")
+    parser.add_argument("--push", action="store_true", help="deliver OTPs through the callback route")
+    parser.add_argument("--push-loss", type=float, default=0.0, help="fraction of OTP callbacks never sent")
+    parser.add_argument("--reconcile", action="store_true", help="settle orders from session/historyv2 in batches")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the bot process")
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args()
+
+    port = free_port()
+    secret = "bench-secret" if args.push else ""
+    viotp = FakeViotp(latency=args.viotp_latency, out_of_stock=args.out_of_stock, otp_median=args.otp_median,
+                      otp_sigma=args.otp_sigma, no_otp=args.no_otp, expire=args.otp_wait, seed=args.seed,
+                      callback_url=f"http://127.0.0.1:{port}/otp-callback" if args.push else None,
+                      callback_secret=secret, push_loss=args.push_loss)
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    viotp_url = viotp.serve()
+    telegram_url = telegram.serve()
+
+    workdir = tempfile.mkdtemp(prefix="okvip-bench-")
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        API_TOKEN="bench",
+        VIOTP_BASE_URL=viotp_url,
+        TELEGRAM_API_URL=telegram_url,
+        WEBHOOK_URL=f"http://127.0.0.1:{port}",
+        PORT=str(port),
+        USE_POLLING="false",
+        ORDERS_DB=os.path.join(workdir, "orders.db"),
+        OTP_STATS_FILE=os.path.join(workdir, "otp_stats.json"),
+        OTP_CALLBACK_SECRET=secret,
+        RECONCILE_ENDPOINT="session/historyv2" if args.reconcile else "",
+    )
+    env.update(item.split("=", 1) for item in args.env)
+
+    log = open(os.path.join(workdir, "bot.out"), "w")
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "buy.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+    sampler = ProcessSampler(proc.pid)
+    try:
+        wait_healthy(f"http://127.0.0.1:{port}/health", proc)
+        sampler.start()
+        harness = Harness(args, f"http://127.0.0.1:{port}/{BOT_TOKEN}", telegram)
+        results, elapsed = harness.run()
+    finally:
+        sampler.stop()
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+    numbers = [r["tap_to_number"] for r in results if "tap_to_number" in r]
+    otps = [r["tap_to_otp"] for r in results if "tap_to_otp" in r]
+    errors = {}
+    for r in results:
+        if "error" in r:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    upstream = viotp.stats()["calls"]
+    report = {
+        "version": git_version(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "users": len(results),
+        "elapsed": round(elapsed, 2),
+        "orders_per_second": round(len(numbers) / elapsed, 3) if elapsed else None,
+        "tap_to_number": summary(numbers),
+        "tap_to_otp": summary(otps),
+        "errors": errors,
+        "threads": {"max": max(sampler.threads, default=None), "last": sampler.threads[-1] if sampler.threads else None},
+        "rss_mb": {"max": round(max(sampler.rss_kb, default=0) / 1024, 1),
+                   "last": round(sampler.rss_kb[-1] / 1024, 1) if sampler.rss_kb else None},
+        "upstream_calls": upstream,
+        "otp_pushes": viotp.stats()["pushes"],
+        "upstream_calls_per_otp": round(sum(upstream.values()) / len(otps), 2) if otps else None,
+        "telegram_calls": telegram.stats()["calls"],
+        "bot_log": os.path.join(workdir, "bot.out"),
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
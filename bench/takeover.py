@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Two-process check of the shared SQLite state: worker A rents a number and
+# is killed while holding the OTP lease, worker B's reaper takes the order
+# over once the lease expires, and the OTP callback is delivered by B only.
+#
+#   python bench/takeover.py
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from fake_telegram import FakeTelegram
+from fake_viotp import FakeViotp
+from run import BOT_TOKEN, NUMBER_OK, OTP_OK, ROOT, SERVICE_BUTTONS, free_port, wait_healthy
+
+SECRET = "takeover-secret"
+CHAT_ID = 424242
+
+
+def wait_until(predicate, timeout, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        value = predicate()
+        if value:
+            return value
+        time.sleep(interval)
+    return None
+
+
+class Worker:
+    def __init__(self, name, env, workdir):
+        self.name = name
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log_path = os.path.join(workdir, f"{name}.out")
+        self._log = open(self.log_path, "w")
+        self.proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "buy.py")], cwd=workdir,
+                                     env=dict(env, PORT=str(self.port), WEBHOOK_URL=self.url),
+                                     stdout=self._log, stderr=subprocess.STDOUT)
+        wait_healthy(f"{self.url}/health", self.proc)
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{self.proc.pid}"
+
+    def post_update(self, update_id, update):
+        requests.post(f"{self.url}/{BOT_TOKEN}", json=dict(update, update_id=update_id), timeout=10)
+
+    def push(self, request_id, code):
+        body = json.dumps({"RequestId": int(request_id), "Status": 1, "Code": code, "IsSound": "false"}).encode()
+        signature = hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+        response = requests.post(f"{self.url}/otp-callback", data=body, timeout=10, headers={
+            "Content-Type": "application/json", "X-Signature": f"sha256={signature}"})
+        return response.json().get("outcome")
+
+    def kill(self):
+        self.proc.send_signal(signal.SIGKILL)
+        self.proc.wait()
+        self._log.close()
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if not self._log.closed:
+            self._log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lease takeover between two bot processes")
+    parser.add_argument("--lease-ttl", type=float, default=4)
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each step")
+    args = parser.parse_args()
+
+    # OTPs never arrive on their own; the check releases one by hand.
+    viotp = FakeViotp(latency=0.02, jitter=0.0, otp_median=10 ** 6, seed=1)
+    telegram = FakeTelegram(latency=0.0)
+    workdir = tempfile.mkdtemp(prefix="okvip-takeover-")
+    state_db = os.path.join(workdir, "state.db")
+    orders_db = os.path.join(workdir, "orders.db")
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        API_TOKEN="bench",
+        VIOTP_BASE_URL=viotp.serve(),
+        TELEGRAM_API_URL=telegram.serve(),
+        USE_POLLING="false",
+        STATE_BACKEND="sqlite",
+        STATE_DB=state_db,
+        ORDERS_DB=orders_db,
+        OTP_STATS_FILE=os.path.join(workdir, "otp_stats.json"),
+        LEASE_TTL=str(args.lease_ttl),
+        # Push mode polls only every OTP_FALLBACK_INTERVAL, so the callback
+        # below reaches B before B's own poll would find the OTP.
+        OTP_CALLBACK_SECRET=SECRET,
+    )
+
+    def lease_owner(request_id):
+        with sqlite3.connect(state_db) as db:
+            row = db.execute("SELECT owner, expires FROM leases WHERE key = ?", (request_id,)).fetchone()
+        return row[0] if row and row[1] > time.time() else None
+
+    def order_status(request_id):
+        with sqlite3.connect(orders_db) as db:
+            row = db.execute("SELECT status FROM orders WHERE request_id = ?", (request_id,)).fetchone()
+        return row[0] if row else None
+
+    report = {"workdir": workdir}
+    workers = []
+    try:
+        a = Worker("a", env, workdir)
+        b = Worker("b", env, workdir)
+        workers += [a, b]
+        sender = {"id": CHAT_ID, "is_bot": False, "first_name": "takeover"}
+        chat = {"id": CHAT_ID, "type": "private"}
+        a.post_update(1, {"message": {"message_id": 1, "date": int(time.time()), "chat": chat, "from": sender,
+                                      "text": SERVICE_BUTTONS[0]}})
+        menu = telegram.wait_for(CHAT_ID, lambda e: "reply_markup" in e["params"], args.timeout)
+        markup = menu["params"]["reply_markup"]
+        markup = json.loads(markup) if isinstance(markup, str) else markup
+        button = next(k for row in markup["inline_keyboard"] for k in row if "callback_data" in k)
+        a.post_update(2, {"callback_query": {
+            "id": "tap", "from": sender, "chat_instance": str(CHAT_ID), "data": button["callback_data"],
+            "message": {"message_id": menu["message_id"], "date": int(time.time()), "chat": chat,
+                        "from": {"id": 1, "is_bot": True, "first_name": "Fake"}, "text": "menu"},
+        }})
+        if telegram.wait_for(CHAT_ID, lambda e: NUMBER_OK in e["params"].get("text", ""), args.timeout) is None:
+            raise RuntimeError("worker A did not rent a number")
+        request_id = str(next(iter(viotp.orders)))
+        report["request_id"] = request_id
+        if not wait_until(lambda: order_status(request_id) == "waiting", args.timeout):
+            raise RuntimeError("order was not stored as waiting")
+        report["lease_before"] = "a" if lease_owner(request_id) == a.owner else lease_owner(request_id)
+
+        a.kill()
+        killed = time.monotonic()
+        taken = wait_until(lambda: lease_owner(request_id) == b.owner, args.timeout + args.lease_ttl)
+        report["takeover_seconds"] = round(time.monotonic() - killed, 2) if taken else None
+
+        # A restarted A shares the files but must leave B's order alone.
+        a2 = Worker("a2", env, workdir)
+        workers.append(a2)
+        viotp.orders[request_id]["arrives"] = time.time() - 1
+        code = viotp.orders[request_id]["code"]
+        report["push_to_a2"] = a2.push(request_id, code)
+        report["push_to_b"] = b.push(request_id, code)
+        report["push_to_b_again"] = b.push(request_id, code)
+        time.sleep(args.lease_ttl)
+        with telegram._cond:
+            otps = [e for e in telegram.by_chat.get(CHAT_ID, ()) if OTP_OK in e["params"].get("text", "")]
+        report["otp_messages"] = len(otps)
+        report["otp_code_ok"] = bool(otps) and code in otps[0]["params"]["text"]
+        report["order_status"] = order_status(request_id)
+    finally:
+        for worker in workers:
+            worker.stop()
+
+    checks = {
+        "a held the lease": report.get("lease_before") == "a",
+        "b took the order over": report.get("takeover_seconds") is not None,
+        "push to a2 not delivered": report.get("push_to_a2") == "unmatched",
+        "push to b delivered": report.get("push_to_b") == "delivered",
+        "repeat push not delivered": report.get("push_to_b_again") != "delivered",
+        "otp sent exactly once": report.get("otp_messages") == 1 and report.get("otp_code_ok"),
+        "order completed": report.get("order_status") == "completed",
+    }
+    report["checks"] = checks
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
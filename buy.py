@@ -1,15 +1,51 @@
 # -*- coding: utf-8 -*-
-import os
 import time
+BOOT_STARTED = time.monotonic()
+import os
+import sys
+import json
+import hashlib
+import functools
+import hmac
+import random
+import atexit
+import heapq
+import itertools
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
 import threading
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+import sqlite3
+import socket
 import requests
-from collections import defaultdict
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from collections import defaultdict, deque
 from datetime import datetime
-from flask import Flask, request, jsonify
+from urllib.parse import urlparse
+from flask import Flask, Response, request, jsonify
 import telebot
 from telebot import types
 
+# ==================== STARTUP ====================
+startup_phases = []
+
+def startup_mark(phase):
+    startup_phases.append((phase, time.monotonic()))
+
+def startup_report():
+    report = {}
+    previous = BOOT_STARTED
+    for phase, at in startup_phases:
+        report[phase] = round(at - previous, 3)
+        previous = at
+    report["total"] = round(previous - BOOT_STARTED, 3)
+    return report
+
+startup_mark("imports")
+
 # ==================== CONFIGURATION ====================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_TOKEN = os.getenv("API_TOKEN")
@@ -19,28 +55,1158 @@ ADMIN_ID = os.getenv("ADMIN_ID")
 if not all([BOT_TOKEN, API_TOKEN]):
     raise RuntimeError("❌ Missing BOT_TOKEN or API_TOKEN")
 
-BASE_URL = "https://api.viotp.com"
+BASE_URL = os.getenv("VIOTP_BASE_URL", "https://api.viotp.com").rstrip('/')
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 USE_PROXY = os.getenv("USE_PROXY", "false").lower() == "true"
 PROXY_URL = os.getenv("PROXY_URL")
 USE_POLLING = os.getenv("USE_POLLING", "false").lower() == "true"
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+OTP_POLL_INTERVAL = float(os.getenv("OTP_POLL_INTERVAL", 3))
+OTP_MAX_POLLS = int(os.getenv("OTP_MAX_POLLS", 120))
+OTP_WORKERS = int(os.getenv("OTP_WORKERS", 4))
+OTP_TIMEOUT = float(os.getenv("OTP_TIMEOUT", OTP_POLL_INTERVAL * OTP_MAX_POLLS))
+# Push delivery: when a secret is set, viotp-style callbacks on
+# OTP_CALLBACK_PATH deliver OTPs and polling drops to a slow fallback.
+OTP_CALLBACK_SECRET = os.getenv("OTP_CALLBACK_SECRET", "")
+OTP_CALLBACK_PATH = "/" + os.getenv("OTP_CALLBACK_PATH", "otp-callback").strip('/')
+OTP_FALLBACK_INTERVAL = float(os.getenv("OTP_FALLBACK_INTERVAL", 30))
+# Batched reconciliation: pending orders are settled from the paged request
+# history (e.g. session/historyv2) and only polled one by one when it misses them.
+RECONCILE_ENDPOINT = os.getenv("RECONCILE_ENDPOINT", "")
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", 3))
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", 100))
+RECONCILE_MAX_PAGES = int(os.getenv("RECONCILE_MAX_PAGES", 3))
+# Async mode: upstream calls, OTP polls and Telegram sends run as coroutines
+# on one event loop over a pooled aiohttp client (optional dependency).
+ASYNC_MODE = os.getenv("ASYNC_MODE", "false").lower() == "true"
+ASYNC_HTTP_LIMIT = int(os.getenv("ASYNC_HTTP_LIMIT", 100))
+ASYNC_BLOCKING_WORKERS = int(os.getenv("ASYNC_BLOCKING_WORKERS", 4))
+HTTP_POOL_SLACK = int(os.getenv("HTTP_POOL_SLACK", 4))
+HTTP_WARM_CONNECTIONS = int(os.getenv("HTTP_WARM_CONNECTIONS", 2))
+HTTP_KEEPALIVE_INTERVAL = float(os.getenv("HTTP_KEEPALIVE_INTERVAL", 45))
+OTP_STATS_FILE = os.getenv("OTP_STATS_FILE", "otp_stats.json")
+ORDERS_DB = os.getenv("ORDERS_DB", "orders.db")
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_DB = os.getenv("STATE_DB", ORDERS_DB)
+LEASE_TTL = float(os.getenv("LEASE_TTL", 60))
+BALANCE_TTL = float(os.getenv("BALANCE_TTL", 30))
+STOCK_TTL = float(os.getenv("STOCK_TTL", 30))
+STOCK_MAX_TTL = float(os.getenv("STOCK_MAX_TTL", 300))
+STOCK_PROBE_ENDPOINT = os.getenv("STOCK_PROBE_ENDPOINT")
+API_BUDGET_INTERACTIVE = float(os.getenv("API_BUDGET_INTERACTIVE", 8))
+API_BUDGET_BACKGROUND = float(os.getenv("API_BUDGET_BACKGROUND", 20))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 10))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 500))
+UPDATE_CHAT_LIMIT = int(os.getenv("UPDATE_CHAT_LIMIT", 10))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 4))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", 3))
+ORDERS_PER_CHAT = int(os.getenv("ORDERS_PER_CHAT", 50))
+ORDERS_IDLE_TTL = float(os.getenv("ORDERS_IDLE_TTL", 3600))
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", 5))
+ORDERS_MAX_WAITING = int(os.getenv("ORDERS_MAX_WAITING", 3))
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", 60))
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", 5))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", 1.0))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", 10 * 1024 * 1024))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 60))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
 # ==================== LOGGING ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('bot.log'), logging.StreamHandler()]
-)
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('order_id', 'chat_id', 'endpoint', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class SampleFilter(logging.Filter):
+    # Records logged with a sample_key pass `burst` times per window; the
+    # rest are dropped and counted on the next record that gets through.
+    def __init__(self, window=LOG_SAMPLE_WINDOW, burst=LOG_SAMPLE_BURST):
+        super().__init__()
+        self._window = window
+        self._burst = burst
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample_key', None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            started, count, suppressed = self._state.get(key, (now, 0, 0))
+            if now - started >= self._window:
+                started, count = now, 0
+            if count >= self._burst:
+                self._state[key] = (started, count, suppressed + 1)
+                return False
+            self._state[key] = (started, count + 1, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class BackgroundQueueHandler(QueueHandler):
+    # The stock prepare() formats in the calling thread; leave that to the
+    # listener and drop records rather than block when the queue is full.
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding='utf-8')
+    else:
+        file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    handler = BackgroundQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SampleFilter())
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers[:] = [handler]
+    listener = QueueListener(handler.queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
+
+log_handler = setup_logging()
 logger = logging.getLogger(__name__)
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
+# ==================== METRICS ====================
+class Metrics:
+    # Minimal Prometheus text-format registry: counters, histograms and
+    # gauges whose values are read from callbacks at scrape time.
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        self._meta[name] = ('histogram', help, buckets)
+
+    def gauge(self, name, help, fn):
+        self._meta[name] = ('gauge', help, None)
+        self._gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._meta[name][2]
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        body = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+        return "{" + body + "}"
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: ([*v[0]], v[1], v[2]) for k, v in self._histograms.items()}
+        lines = []
+        for name, (kind, help, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (n, labels), value in counters.items():
+                    if n == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+            elif kind == 'histogram':
+                for (n, labels), (counts, total, count) in histograms.items():
+                    if n != name:
+                        continue
+                    for bound, c in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{self._labels(labels, ('le', bound))} {c}")
+                    lines.append(f"{name}_bucket{self._labels(labels, ('le', '+Inf'))} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+            else:
+                try:
+                    lines.append(f"{name} {self._gauges[name]()}")
+                except Exception as e:
+                    logger.error("Gauge %s error: %s", name, e)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("viotp_request_seconds", "Latency of viotp API calls")
+metrics.counter("viotp_errors_total", "viotp API calls that did not return status_code 200")
+metrics.histogram("telegram_request_seconds", "Latency of outgoing Telegram send/edit calls")
+metrics.counter("telegram_errors_total", "Failed outgoing Telegram send/edit calls")
+metrics.counter("http_checkouts_total", "HTTP requests that checked a connection out of a pool, by host")
+metrics.counter("http_connects_total", "New TCP/TLS connections opened, by host")
+metrics.histogram("http_connect_seconds", "Time spent opening TCP/TLS connections", buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+metrics.histogram("http_pool_wait_seconds", "Time spent getting a connection from a pool", buckets=(0.0001, 0.001, 0.01, 0.1, 1))
+metrics.counter("rent_rejected_total", "Rent taps turned away before create_order, by reason")
+metrics.histogram("rent_phase_seconds", "Time from a rent tap to each phase of callback_rent completing")
+metrics.histogram("otp_wait_seconds", "Time from order creation to OTP delivery",
+                  buckets=(5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 360))
+
+# ==================== TRACING ====================
+class Span:
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'attrs', 'started', 'wall')
+
+    def __init__(self, tracer, name, trace_id, parent_id, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attrs = attrs
+
+    @property
+    def context(self):
+        return (self.trace_id, self.span_id)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.started = time.monotonic()
+        self.tracer._stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer._stack().pop()
+        if exc is not None:
+            self.attrs["error"] = repr(exc)
+        self.tracer.emit(self, time.monotonic() - self.started)
+        return False
+
+class NullSpan:
+    context = None
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class SpanFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False, default=str)
+
+class Tracer:
+    # A trace starts at the webhook and follows the order through the update
+    # worker, the rent handler, every OTP poll and the Telegram sends it
+    # causes. Roots are sampled; spans go to a rotating JSONL file through
+    # the same background queue the logs use.
+    def __init__(self, path=TRACE_FILE, sample=TRACE_SAMPLE):
+        self.enabled = bool(path) and sample > 0
+        self._sample = sample
+        self._local = threading.local()
+        self._logger = logging.getLogger("okvip.trace")
+        self._logger.propagate = False
+        if not self.enabled:
+            return
+        file_handler = RotatingFileHandler(path, maxBytes=TRACE_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+        file_handler.setFormatter(SpanFormatter())
+        self.handler = BackgroundQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        self._logger.addHandler(self.handler)
+        self._logger.setLevel(logging.INFO)
+        listener = QueueListener(self.handler.queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1].context if stack else None
+
+    def annotate(self, **attrs):
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            stack[-1].attrs.update(attrs)
+
+    def span(self, name, parent=None, root=False, **attrs):
+        # Without an explicit parent the span joins the thread's current one;
+        # only root spans may start a new trace.
+        if not self.enabled:
+            return NULL_SPAN
+        if parent is None:
+            parent = self.current()
+        if parent is not None:
+            return Span(self, name, parent[0], parent[1], attrs)
+        if root and random.random() < self._sample:
+            return Span(self, name, f"{random.getrandbits(128):032x}", None, attrs)
+        return NULL_SPAN
+
+    def emit(self, span, duration):
+        self._logger.info({
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "start": round(span.wall, 6),
+            "duration_ms": round(duration * 1000, 3),
+            "thread": threading.current_thread().name,
+            "attrs": span.attrs,
+        })
+
+tracer = Tracer()
+
+def traced(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    # Samples every thread's stack with sys._current_frames() and counts
+    # them in collapsed form ("thread;outer;...;inner count"), which
+    # flamegraph.pl and speedscope read directly.
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self._interval = interval
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def run(self, seconds):
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            me = threading.get_ident()
+            counts = defaultdict(int)
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    counts[";".join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(self._interval)
+            lines = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda i: -i[1])]
+            return samples, "\n".join(lines) + "\n"
+        finally:
+            self._lock.release()
+
+profiler = SamplingProfiler()
+
 # ==================== FLASK & BOT ====================
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=10)
+class InstrumentedBot(telebot.TeleBot):
+    def _timed(self, method, call, *args, **kwargs):
+        started = time.monotonic()
+        result = "ok"
+        try:
+            return call(*args, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            result = str(e.error_code)
+            raise
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            metrics.observe("telegram_request_seconds", time.monotonic() - started, method=method, result=result)
+            if result != "ok":
+                metrics.inc("telegram_errors_total", method=method, result=result)
+
+    def send_message(self, *args, **kwargs):
+        return self._timed("sendMessage", super().send_message, *args, **kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._timed("editMessageText", super().edit_message_text, *args, **kwargs)
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+bot = InstrumentedBot(BOT_TOKEN, threaded=False)
+
+# ==================== OUTBOUND ====================
+PRIORITY_ACK = 0
+PRIORITY_OTP = 1
+PRIORITY_REPLY = 2
+PRIORITY_EDIT = 3
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class OutboundJob:
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'args', 'kwargs', 'future',
+                 'edit_key', 'attempts', 'queued_at', 'trace')
+
+    def __init__(self, priority, seq, chat_id, method, args, kwargs, edit_key=None):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.edit_key = edit_key
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+        self.trace = tracer.current()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundDispatcher:
+    # Every outgoing send/edit goes through here. Jobs leave in priority order
+    # under a global and a per-chat token bucket, one at a time per chat so a
+    # chat's messages keep their order. A pending edit of the same message is
+    # replaced by the newer one, and 429s park the chat for retry_after.
+    # Jobs without a chat (callback answers) only take a global token.
+    # Each chat has its own lane; a heap holds the head of every lane that
+    # may send and another the chats waiting on their bucket, keyed by when
+    # they can send again, so a dispatch never walks the rate-limited backlog.
+    def __init__(self, workers=OUTBOUND_WORKERS, global_rate=TG_GLOBAL_RATE,
+                 chat_rate=TG_CHAT_RATE, chat_burst=TG_CHAT_BURST, max_attempts=5):
+        self._workers = workers
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_attempts = max_attempts
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._busy = set()
+        self._lanes = {}
+        self._ready = []
+        self._parked = []
+        self._parked_chats = set()
+        self._size = 0
+        self._edits = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._jobs = queue.Queue()
+        self._started = False
+        self._pruned_at = time.monotonic()
+
+    def __len__(self):
+        return self._size
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._dispatch_loop, name="outbound-dispatcher", daemon=True).start()
+        if async_runtime is not None:
+            return
+        for i in range(self._workers):
+            threading.Thread(target=self._send_loop, name=f"outbound-sender-{i}", daemon=True).start()
+
+    def submit(self, priority, chat_id, method, *args, **kwargs):
+        job = OutboundJob(priority, next(self._seq), chat_id, method, args, kwargs)
+        with self._cond:
+            self._enqueue(job)
+            self._cond.notify()
+        self.start()
+        return job.future
+
+    def edit(self, chat_id, message_id, text, **kwargs):
+        key = (chat_id, message_id)
+        with self._cond:
+            job = self._edits.get(key)
+            if job is not None:
+                job.args = (text, chat_id, message_id)
+                job.kwargs = kwargs
+                metrics.inc("telegram_edits_merged_total")
+                return job.future
+            job = OutboundJob(PRIORITY_EDIT, next(self._seq), chat_id, 'edit_message_text',
+                              (text, chat_id, message_id), kwargs, edit_key=key)
+            self._edits[key] = job
+            self._enqueue(job)
+            self._cond.notify()
+        self.start()
+        return job.future
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _enqueue(self, job):
+        lane = self._lanes.setdefault(job.chat_id, [])
+        heapq.heappush(lane, job)
+        self._size += 1
+        if lane[0] is job:
+            self._offer(job.chat_id)
+
+    def _offer(self, chat_id):
+        # Entries left behind by a newer head, or for a chat that has since
+        # become busy or parked, are dropped when they reach the top.
+        lane = self._lanes.get(chat_id)
+        if lane and chat_id not in self._busy and chat_id not in self._parked_chats:
+            heapq.heappush(self._ready, (lane[0].priority, lane[0].seq, chat_id))
+
+    def _park(self, chat_id, until):
+        self._parked_chats.add(chat_id)
+        heapq.heappush(self._parked, (until, next(self._seq), chat_id))
+
+    def _next_job(self):
+        while True:
+            now = time.monotonic()
+            if now - self._pruned_at > 60:
+                self._prune(now)
+            while self._parked and self._parked[0][0] <= now:
+                chat_id = heapq.heappop(self._parked)[2]
+                self._parked_chats.discard(chat_id)
+                self._offer(chat_id)
+            wait = self._parked[0][0] - now if self._parked else None
+            while self._ready:
+                priority, seq, chat_id = self._ready[0]
+                lane = self._lanes.get(chat_id)
+                if (not lane or lane[0].seq != seq or lane[0].priority != priority
+                        or chat_id in self._busy or chat_id in self._parked_chats):
+                    heapq.heappop(self._ready)
+                    continue
+                if chat_id is not None:
+                    delay = self._bucket(chat_id).delay(now)
+                    if delay > 0:
+                        heapq.heappop(self._ready)
+                        self._park(chat_id, now + delay)
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                delay = self._global.delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+                heapq.heappop(self._ready)
+                job = heapq.heappop(lane)
+                self._size -= 1
+                if not lane:
+                    del self._lanes[chat_id]
+                self._global.consume()
+                if chat_id is None:
+                    self._offer(None)
+                else:
+                    self._bucket(chat_id).consume()
+                    self._busy.add(chat_id)
+                if job.edit_key is not None:
+                    self._edits.pop(job.edit_key, None)
+                return job
+            self._cond.wait(wait)
+
+    def _prune(self, now):
+        self._pruned_at = now
+        pending = set(self._lanes) | self._busy
+        for chat_id in [c for c, b in self._chats.items() if c not in pending and now - b.updated > 60]:
+            del self._chats[chat_id]
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+            if async_runtime is not None:
+                async_runtime.submit(self._send_async(job))
+            else:
+                self._jobs.put(job)
+
+    def _send_loop(self):
+        while True:
+            job = self._jobs.get()
+            self._begin(job)
+            try:
+                with tracer.span("send", parent=job.trace, method=job.method, chat_id=job.chat_id, attempt=job.attempts):
+                    result = getattr(bot, job.method)(*job.args, **job.kwargs)
+            except Exception as e:
+                self._settle(job, error=e)
+            else:
+                self._settle(job, result)
+
+    async def _send_async(self, job):
+        self._begin(job)
+        try:
+            result = await async_runtime.telegram(job.method, job.args, job.kwargs)
+        except Exception as e:
+            self._settle(job, error=e)
+        else:
+            self._settle(job, result)
+
+    def _begin(self, job):
+        metrics.observe("outbound_wait_seconds", time.monotonic() - job.queued_at, priority=job.priority)
+        job.attempts += 1
+
+    def _settle(self, job, result=None, error=None):
+        retry = False
+        if error is None:
+            job.future.set_result(result)
+        elif isinstance(error, telebot.apihelper.ApiTelegramException):
+            if error.error_code == 429 and job.attempts < self._max_attempts:
+                retry_after = (error.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                metrics.inc("telegram_429_total")
+                with self._cond:
+                    bucket = self._global if job.chat_id is None else self._bucket(job.chat_id)
+                    bucket.blocked_until = time.monotonic() + retry_after
+                retry = True
+            else:
+                if 'message is not modified' not in error.description:
+                    logger.error("Telegram %s failed: %s", job.method, error,
+                                 extra={"chat_id": job.chat_id, "sample_key": ("telegram", job.method, error.error_code)})
+                job.future.set_exception(error)
+        elif isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            if job.attempts < self._max_attempts:
+                if job.chat_id is not None:
+                    with self._cond:
+                        self._bucket(job.chat_id).blocked_until = time.monotonic() + job.attempts
+                retry = True
+            else:
+                logger.error("Telegram %s failed: %s", job.method, error,
+                             extra={"chat_id": job.chat_id, "sample_key": ("telegram", job.method, "network")})
+                job.future.set_exception(error)
+        else:
+            logger.error("Telegram %s failed: %s", job.method, error,
+                         extra={"chat_id": job.chat_id, "sample_key": ("telegram", job.method, "error")})
+            job.future.set_exception(error)
+        with self._cond:
+            self._busy.discard(job.chat_id)
+            if retry:
+                heapq.heappush(self._lanes.setdefault(job.chat_id, []), job)
+                self._size += 1
+            self._offer(job.chat_id)
+            self._cond.notify()
+
+outbound = OutboundDispatcher()
+
+def send_message(chat_id, text, priority=PRIORITY_REPLY, **kwargs):
+    return outbound.submit(priority, chat_id, 'send_message', chat_id, text, **kwargs)
+
+def reply_to(message, text, priority=PRIORITY_REPLY, **kwargs):
+    return send_message(message.chat.id, text, priority, reply_to_message_id=message.message_id, **kwargs)
+
+def edit_message_text(text, chat_id, message_id, **kwargs):
+    return outbound.edit(chat_id, message_id, text, **kwargs)
+
+def answer_callback(callback_id, text=None):
+    return outbound.submit(PRIORITY_ACK, None, 'answer_callback_query', callback_id, text)
 
 # ==================== STORAGE ====================
-user_orders = defaultdict(dict)
-active_checks = {}
+ORDER_FIELDS = ('request_id', 'chat_id', 'phone', 'service', 'service_id', 'network',
+                'network_code', 'status', 'otp', 'created_at', 'created_ts')
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class Order:
+    # Service, network and status strings are interned so every order points
+    # at the same few objects; the display name of the network is derived.
+    __slots__ = ('request_id', 'chat_id', 'phone', 'service', 'service_id',
+                 'network_code', 'status', 'otp', 'created_ts')
+
+    def __init__(self, request_id, chat_id, phone, service, service_id, network_code,
+                 status='waiting', otp=None, created_ts=None):
+        self.request_id = str(request_id)
+        self.chat_id = chat_id
+        self.phone = phone
+        self.service = _intern(service)
+        self.service_id = _intern(service_id)
+        self.network_code = _intern(network_code)
+        self.status = _intern(status)
+        self.otp = otp
+        self.created_ts = created_ts or time.time()
+
+    @property
+    def network(self):
+        return NETWORKS.get(self.network_code, self.network_code)
+
+    @property
+    def created_at(self):
+        return datetime.fromtimestamp(self.created_ts).strftime('%H:%M:%S %d/%m')
+
+    def row(self):
+        return tuple(getattr(self, field) for field in ORDER_FIELDS)
+
+    @classmethod
+    def from_row(cls, row):
+        values = dict(zip(ORDER_FIELDS, row))
+        return cls(values['request_id'], values['chat_id'], values['phone'], values['service'],
+                   values['service_id'], values['network_code'], values['status'],
+                   values['otp'], values['created_ts'])
+
+class ChatOrders:
+    __slots__ = ('orders', 'seen')
+
+    def __init__(self, limit):
+        self.orders = deque(maxlen=limit)
+        self.seen = time.monotonic()
+
+class OrderStore:
+    # Each chat keeps a bounded ring of its most recent orders in memory and
+    # idle chats are evicted after idle_ttl; SQLite holds the full history.
+    # Rows are written behind by a single writer thread, so no handler ever
+    # waits on a commit.
+    # With shared=True other processes write to the same file, so reads go
+    # back to the database and only rows with unflushed local writes win.
+    def __init__(self, path=ORDERS_DB, flush_interval=0.5, batch_size=200, shared=False,
+                 per_chat=ORDERS_PER_CHAT, idle_ttl=ORDERS_IDLE_TTL):
+        self._path = path
+        self._shared = shared
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._per_chat = per_chat
+        self._idle_ttl = idle_ttl
+        self._chats = {}
+        self._index = {}
+        self._dirty = defaultdict(int)
+        self._user_count = (0.0, 0)
+        self._swept_at = time.monotonic()
+        self._writes = queue.Queue()
+        self._lock = threading.Lock()
+        self._db = self._connect()
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                request_id TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                phone TEXT,
+                service TEXT,
+                service_id TEXT,
+                network TEXT,
+                network_code TEXT,
+                status TEXT NOT NULL,
+                otp TEXT,
+                created_at TEXT,
+                created_ts REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_orders_chat ON orders (chat_id, created_ts);
+            CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status);
+        """)
+        self._users = self._db.execute("SELECT COUNT(DISTINCT chat_id) FROM orders").fetchone()[0]
+        threading.Thread(target=self._writer_loop, name="order-writer", daemon=True).start()
+
+    def _connect(self):
+        db = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        return db
+
+    def __len__(self):
+        if not self._shared:
+            return self._users
+        checked_at, count = self._user_count
+        if time.time() - checked_at > 5:
+            with self._lock:
+                count = self._db.execute("SELECT COUNT(DISTINCT chat_id) FROM orders").fetchone()[0]
+            self._user_count = (time.time(), count)
+        return count
+
+    def add(self, order):
+        with self._lock:
+            self._remember(order)
+            self._maybe_sweep()
+        self._write(order)
+
+    def update(self, request_id, on_commit=None, **fields):
+        # on_commit runs once the new row is in the database (or right away
+        # if there is no such order).
+        request_id = str(request_id)
+        order = self._index.get(request_id) or self._load_order(request_id)
+        if order is None:
+            if on_commit is not None:
+                on_commit()
+            return None
+        for name, value in fields.items():
+            setattr(order, name, _intern(value) if name == 'status' else value)
+        self._write(order, on_commit)
+        return order
+
+    def get(self, request_id):
+        request_id = str(request_id)
+        return self._index.get(request_id) or self._load_order(request_id)
+
+    def count(self, chat_id):
+        if self._shared:
+            return len(self._shared_view(chat_id))
+        with self._lock:
+            return len(self._chat(chat_id).orders)
+
+    def recent(self, chat_id, limit=10, offset=0):
+        if self._shared:
+            return self._shared_view(chat_id)[offset:offset + limit]
+        with self._lock:
+            chat = self._chat(chat_id)
+            chat.seen = time.monotonic()
+            return list(itertools.islice(reversed(chat.orders), offset, offset + limit))
+
+    def _shared_view(self, chat_id):
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(ORDER_FIELDS)} FROM orders WHERE chat_id = ? ORDER BY created_ts DESC LIMIT ?",
+                (chat_id, self._per_chat)
+            ).fetchall()
+            orders = {row[0]: Order.from_row(row) for row in rows}
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                for order in chat.orders:
+                    if order.request_id in self._dirty or order.request_id not in orders:
+                        orders[order.request_id] = order
+        return sorted(orders.values(), key=lambda o: o.created_ts, reverse=True)[:self._per_chat]
+
+    def waiting(self):
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(ORDER_FIELDS)} FROM orders WHERE status = 'waiting' ORDER BY created_ts"
+            ).fetchall()
+        for row in rows:
+            # A local write still in the queue may already have settled it.
+            if row[0] in self._dirty:
+                continue
+            order = self._index.get(row[0])
+            yield order if order is not None and not self._shared else Order.from_row(row)
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatOrders(self._per_chat)
+            rows = self._db.execute(
+                f"SELECT {', '.join(ORDER_FIELDS)} FROM orders WHERE chat_id = ? ORDER BY created_ts DESC LIMIT ?",
+                (chat_id, self._per_chat)
+            ).fetchall()
+            for row in reversed(rows):
+                order = self._index.get(row[0]) or Order.from_row(row)
+                chat.orders.append(order)
+                self._index[order.request_id] = order
+        return chat
+
+    def _remember(self, order):
+        chat = self._chat(order.chat_id)
+        chat.seen = time.monotonic()
+        if not chat.orders:
+            self._users += 1
+        if len(chat.orders) == chat.orders.maxlen:
+            self._forget(chat.orders[0])
+        chat.orders.append(order)
+        self._index[order.request_id] = order
+
+    def _forget(self, order):
+        if order.status != 'waiting' and order.request_id not in self._dirty:
+            self._index.pop(order.request_id, None)
+
+    def _load_order(self, request_id):
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(ORDER_FIELDS)} FROM orders WHERE request_id = ?",
+                (request_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            order = self._index.get(request_id)
+            if order is None:
+                # Loading the chat indexes its recent orders, this one
+                # included unless it is older than the ring holds.
+                chat = self._chat(row[1])
+                chat.seen = time.monotonic()
+                order = self._index.get(request_id) or Order.from_row(row)
+            return order
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._swept_at < 60:
+            return
+        self._swept_at = now
+        for chat_id, chat in list(self._chats.items()):
+            if now - chat.seen < self._idle_ttl:
+                continue
+            if any(o.status == 'waiting' or o.request_id in self._dirty for o in chat.orders):
+                continue
+            del self._chats[chat_id]
+            for order in chat.orders:
+                self._index.pop(order.request_id, None)
+
+    def stats(self):
+        return {"chats": len(self._chats), "orders": len(self._index), "pending_writes": self._writes.qsize()}
+
+    def _write(self, order, on_commit=None):
+        with self._lock:
+            self._dirty[order.request_id] += 1
+        self._writes.put((order.row(), on_commit))
+
+    def _writer_loop(self):
+        db = self._connect()
+        sql = (f"INSERT OR REPLACE INTO orders ({', '.join(ORDER_FIELDS)}) "
+               f"VALUES ({', '.join('?' * len(ORDER_FIELDS))})")
+        while True:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                db.execute("BEGIN")
+                db.executemany(sql, [row for row, _ in batch])
+                db.execute("COMMIT")
+            except Exception as e:
+                logger.error("Order store write error: %s", e, extra={"sample_key": ("order_store",)})
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+            finally:
+                with self._lock:
+                    for row, _ in batch:
+                        request_id = row[0]
+                        self._dirty[request_id] -= 1
+                        if self._dirty[request_id] <= 0:
+                            del self._dirty[request_id]
+                for _, on_commit in batch:
+                    if on_commit is not None:
+                        try:
+                            on_commit()
+                        except Exception as e:
+                            logger.error("Order store callback error: %s", e)
+                    self._writes.task_done()
+
+    def flush(self):
+        self._writes.join()
+
+# ==================== SHARED STATE ====================
+class MemoryState:
+    # Default backend: leases only need to be unique within this process.
+    # Slots are spread over a fixed set of locks by group, so unrelated
+    # chats never wait on each other.
+    shared = False
+
+    def __init__(self, stripes=64):
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            held = self._leases.get(key)
+            if held and held[0] != owner and held[1] > now:
+                return False
+            self._leases[key] = (owner, now + ttl)
+            return True
+
+    def release(self, key, owner):
+        with self._lock:
+            held = self._leases.get(key)
+            if held and held[0] == owner:
+                del self._leases[key]
+
+    def active_count(self):
+        now = time.time()
+        with self._lock:
+            return sum(1 for _, expires in self._leases.values() if expires > now)
+
+    def take_slot(self, group, key, owner, ttl, limit=None, replace=False):
+        # Holds key in group unless another owner does (or replace is set),
+        # and, for a new key, only while the group has fewer than limit.
+        now = time.time()
+        with self._stripes[hash(group) % len(self._stripes)]:
+            slots = self._slots.setdefault(group, {})
+            held = slots.get(key)
+            if held and held[1] > now:
+                ok = replace or held[0] == owner
+            else:
+                ok = limit is None or sum(1 for _, expires in slots.values() if expires > now) < limit
+            if ok:
+                slots[key] = (owner, now + ttl)
+            return ok
+
+    def release_slot(self, group, key, owner):
+        with self._stripes[hash(group) % len(self._stripes)]:
+            slots = self._slots.get(group)
+            if slots and slots.get(key, (None,))[0] == owner:
+                del slots[key]
+                if not slots:
+                    del self._slots[group]
+
+    def slot_count(self, group):
+        now = time.time()
+        return sum(1 for _, expires in list(self._slots.get(group, {}).values()) if expires > now)
+
+class SqliteState:
+    # Leases in a SQLite file shared by every gunicorn worker on the host. An
+    # acquire only succeeds if the lease is free, expired or already ours,
+    # so a crashed worker's checks are taken over once its leases lapse.
+    shared = True
+
+    def __init__(self, path=STATE_DB):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_leases_expires ON leases (expires);
+            CREATE TABLE IF NOT EXISTS slots (
+                grp TEXT NOT NULL,
+                key TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (grp, key)
+            );
+        """)
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires <= ?",
+                (str(key), owner, now + ttl, now)
+            )
+            return cur.rowcount == 1
+
+    def release(self, key, owner):
+        with self._lock:
+            self._db.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (str(key), owner))
+
+    def active_count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM leases WHERE expires > ?", (time.time(),)).fetchone()[0]
+
+    def take_slot(self, group, key, owner, ttl, limit=None, replace=False):
+        # BEGIN IMMEDIATE takes the write lock first, so the check and the
+        # insert are one step for every process sharing the file.
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                held = self._db.execute(
+                    "SELECT owner FROM slots WHERE grp = ? AND key = ? AND expires > ?", (group, key, now)
+                ).fetchone()
+                if held:
+                    ok = replace or held[0] == owner
+                else:
+                    ok = limit is None or self._db.execute(
+                        "SELECT COUNT(*) FROM slots WHERE grp = ? AND expires > ?", (group, now)
+                    ).fetchone()[0] < limit
+                if ok:
+                    self._db.execute("INSERT OR REPLACE INTO slots (grp, key, owner, expires) VALUES (?, ?, ?, ?)",
+                                     (group, key, owner, now + ttl))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return ok
+
+    def release_slot(self, group, key, owner):
+        with self._lock:
+            self._db.execute("DELETE FROM slots WHERE grp = ? AND key = ? AND owner = ?", (group, key, owner))
+
+    def slot_count(self, group):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM slots WHERE grp = ? AND expires > ?",
+                                    (group, time.time())).fetchone()[0]
+
+def make_state():
+    if STATE_BACKEND == "sqlite":
+        return SqliteState()
+    if STATE_BACKEND != "memory":
+        logger.error(f"Unknown STATE_BACKEND '{STATE_BACKEND}', using memory")
+    return MemoryState()
+
+TAP_SLOTS = "taps"
+
+def waiting_slots(chat_id):
+    return f"waiting:{chat_id}"
+
+state = make_state()
+order_store = OrderStore(shared=state.shared)
+atexit.register(order_store.flush)
 
 # ==================== SERVICES ====================
 SERVICES = {
@@ -60,53 +1226,303 @@ NETWORKS = {
     'WINTEL': '📡 Wintel',
 }
 
-# ==================== HTTP SESSION ====================
-session = requests.Session()
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+# One-character tags used in callback data; every network needs one.
+NETWORK_TAGS = {
+    'any': 'a',
+    'MOBIFONE': 'm',
+    'VINAPHONE': 'v',
+    'VIETTEL': 't',
+    'VIETNAMOBILE': 'n',
+    'ITELECOM': 'i',
+    'WINTEL': 'w',
+}
+
+# ==================== HTTP POOLS ====================
+class HostStats:
+    __slots__ = ('checkouts', 'connects', 'connect_seconds', 'wait_seconds', 'last_used', 'last_error')
+
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.connect_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.last_used = 0.0
+        self.last_error = None
+
+http_hosts = defaultdict(HostStats)
+
+class CountingConnectionMixin:
+    def connect(self):
+        started = time.monotonic()
+        super().connect()
+        elapsed = time.monotonic() - started
+        host = f"{self.host}:{self.port}"
+        stats = http_hosts[host]
+        stats.connects += 1
+        stats.connect_seconds += elapsed
+        metrics.inc("http_connects_total", host=host)
+        metrics.observe("http_connect_seconds", elapsed, host=host)
+
+class CountingHTTPConnection(CountingConnectionMixin, HTTPConnection):
+    pass
+
+class CountingHTTPSConnection(CountingConnectionMixin, HTTPSConnection):
+    pass
+
+class CountingPoolMixin:
+    def _get_conn(self, timeout=None):
+        started = time.monotonic()
+        conn = super()._get_conn(timeout)
+        elapsed = time.monotonic() - started
+        host = f"{self.host}:{self.port}"
+        stats = http_hosts[host]
+        stats.checkouts += 1
+        stats.wait_seconds += elapsed
+        stats.last_used = time.monotonic()
+        metrics.inc("http_checkouts_total", host=host)
+        metrics.observe("http_pool_wait_seconds", elapsed, host=host)
+        return conn
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+POOL_CLASSES = {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
 
-retry_strategy = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-adapter = HTTPAdapter(pool_connections=20, pool_maxsize=40, max_retries=retry_strategy)
-session.mount('https://', adapter)
-session.mount('http://', adapter)
+class PooledAdapter(HTTPAdapter):
+    # Plain HTTPAdapter whose pools count checkouts and TCP/TLS connects per
+    # host. Retries are done by the callers so they stay inside their budgets.
+    def __init__(self, size):
+        super().__init__(pool_connections=4, pool_maxsize=size, max_retries=0)
 
-if USE_PROXY and PROXY_URL:
-    session.proxies = {'http': PROXY_URL, 'https': PROXY_URL}
-    logger.info("✅ Proxy enabled")
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
 
-session.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"})
+    def proxy_manager_for(self, proxy, **kwargs):
+        manager = super().proxy_manager_for(proxy, **kwargs)
+        manager.pool_classes_by_scheme = POOL_CLASSES
+        return manager
+
+def telegram_base_url():
+    return (TELEGRAM_API_URL or "https://api.telegram.org").rstrip('/')
+
+class HttpPools:
+    # One session per upstream, each pool sized for the threads that call
+    # it: update workers and OTP workers hit viotp, outbound senders hit
+    # Telegram. The viotp session is built on first use; the Telegram one is
+    # built at import because telebot takes it as a module setting, which
+    # only creates its adapter and opens no connection. warm() opens
+    # connections ahead of the traffic and the keep-alive loop re-warms
+    # hosts that went idle long enough for the server to drop their sockets.
+    def __init__(self):
+        self._config = {
+            "viotp": {"base": BASE_URL, "size": UPDATE_WORKERS + OTP_WORKERS + HTTP_POOL_SLACK,
+                      "proxy": USE_PROXY and PROXY_URL,
+                      "headers": {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"}},
+            "telegram": {"base": telegram_base_url(), "size": OUTBOUND_WORKERS + HTTP_POOL_SLACK,
+                         "proxy": None, "headers": {}},
+        }
+        for config in self._config.values():
+            url = urlparse(config["base"])
+            config["host"] = f"{url.hostname}:{url.port or (443 if url.scheme == 'https' else 80)}"
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, name):
+        session = self._sessions.get(name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(name)
+                if session is None:
+                    config = self._config[name]
+                    session = requests.Session()
+                    adapter = PooledAdapter(config["size"])
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    if config["proxy"]:
+                        session.proxies = {'http': PROXY_URL, 'https': PROXY_URL}
+                        logger.info("✅ Proxy enabled for %s", name)
+                    session.headers.update(config["headers"])
+                    self._sessions[name] = session
+        return session
+
+    def _touch(self, name):
+        config = self._config[name]
+        try:
+            self.session(name).head(config["base"] + "/", timeout=5)
+            http_hosts[config["host"]].last_error = None
+        except requests.RequestException as e:
+            http_hosts[config["host"]].last_error = str(e)
+
+    def warm(self, name, connections=HTTP_WARM_CONNECTIONS):
+        # Concurrent requests so the pool ends up holding `connections` sockets.
+        threads = [threading.Thread(target=self._touch, args=(name,), daemon=True)
+                   for _ in range(max(1, connections))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def keepalive_loop(self, interval=HTTP_KEEPALIVE_INTERVAL):
+        for name in self._config:
+            self.warm(name)
+        while interval > 0:
+            time.sleep(interval / 3)
+            for name, config in self._config.items():
+                if time.monotonic() - http_hosts[config["host"]].last_used >= interval:
+                    self.warm(name)
+
+    def stats(self):
+        result = {}
+        for name, config in self._config.items():
+            stats = http_hosts[config["host"]]
+            result[name] = {
+                "host": config["host"],
+                "pool_size": config["size"],
+                "requests": stats.checkouts,
+                "connects": stats.connects,
+                "reuse": round(1 - stats.connects / stats.checkouts, 3) if stats.checkouts else None,
+                "avg_connect_ms": round(stats.connect_seconds / stats.connects * 1000, 1) if stats.connects else None,
+                "avg_wait_ms": round(stats.wait_seconds / stats.checkouts * 1000, 3) if stats.checkouts else None,
+                "last_error": stats.last_error,
+            }
+        return result
+
+http_pools = HttpPools()
+telebot.apihelper.session = http_pools.session("telegram")
+
+# ==================== CIRCUIT BREAKER ====================
+class CircuitBreaker:
+    # Opens after `threshold` consecutive transport failures, fails fast for
+    # `cooldown` seconds, then lets a single probe through (half-open).
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self._cooldown:
+                    return False
+                self.state = 'half_open'
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self._threshold:
+                if self.state != 'open':
+                    logger.error("Circuit opened after %s failures", self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def info(self):
+        info = {"state": self.state, "failures": self.failures}
+        if self.state == 'open':
+            info["retry_in"] = round(max(0.0, self.opened_at + self._cooldown - time.monotonic()), 1)
+        return info
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+breakers = defaultdict(CircuitBreaker)
 
 # ==================== API FUNCTIONS ====================
-def api_call(endpoint, params=None):
-    try:
-        if not params:
-            params = {}
-        params['token'] = API_TOKEN
+def api_call(endpoint, params=None, budget=API_BUDGET_BACKGROUND):
+    # budget bounds the whole call, retries included; interactive callers
+    # pass what is left of theirs.
+    breaker = breakers[endpoint]
+    if not breaker.allow():
+        metrics.inc("viotp_errors_total", endpoint=endpoint, code="breaker_open")
+        return {"status_code": -5, "message": "Circuit open"}
+    
+    params = dict(params or {}, token=API_TOKEN)
+    url = f"{BASE_URL}/{endpoint}"
+    deadline = time.monotonic() + budget
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.monotonic()
+        code = "error"
+        try:
+            response = http_pools.session("viotp").get(url, params=params, timeout=max(0.5, min(15, deadline - started)))
+            code = f"http_{response.status_code}"
+            response.raise_for_status()
+            result = response.json()
+            code = str(result.get("status_code"))
+            breaker.record(True)
+            return result
+        except Exception as e:
+            error = e
+        finally:
+            metrics.observe("viotp_request_seconds", time.monotonic() - started, endpoint=endpoint, code=code)
+            if code != "200":
+                metrics.inc("viotp_errors_total", endpoint=endpoint, code=code)
         
-        url = f"{BASE_URL}/{endpoint}"
-        response = session.get(url, params=params, timeout=15)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        logger.error(f"API Error ({endpoint}): {e}")
-        return {"status_code": -1, "message": str(e)}
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        backoff = api_backoff(endpoint, breaker, error, status, attempt, deadline)
+        if backoff is None:
+            return {"status_code": -1, "message": str(error)}
+        time.sleep(backoff)
 
-def get_balance():
-    result = api_call("users/balance")
+def api_backoff(endpoint, breaker, error, status, attempt, deadline):
+    # Seconds to wait before the next attempt, or None once the call gives up.
+    transient = status is None or status in RETRY_STATUS
+    backoff = min(4, 2 ** (attempt - 1))
+    if transient and deadline - time.monotonic() > backoff + 0.5:
+        return backoff
+    breaker.record(not transient)
+    logger.error("API Error (%s): %s", endpoint, error,
+                 extra={"endpoint": endpoint, "sample_key": ("api", endpoint, type(error).__name__)})
+    return None
+
+def fetch_balance():
+    return balance_result(api_call("users/balance", budget=API_BUDGET_INTERACTIVE))
+
+def balance_result(result):
     if result.get("status_code") == 200:
         return {"status": 1, "balance": result.get("data", {}).get("balance", 0)}
     return {"status": 0, "message": "Không lấy được số dư"}
 
-def create_order(service_id, network=None):
+def get_balance():
+    return balance_cache.get()
+
+def order_params(service_id, network=None):
     params = {"serviceId": service_id, "country": COUNTRY}
     
     if network and network != 'any':
         params['network'] = network
-    
-    result = api_call("request/getv2", params)
+    return params
+
+@traced("create_order")
+def create_order(service_id, network=None, budget=API_BUDGET_INTERACTIVE):
+    return order_result(api_call("request/getv2", order_params(service_id, network), budget), service_id, network)
+
+def order_result(result, service_id, network=None):
+    if result.get("status_code") in (-3, -4):
+        stock_cache.mark_unavailable(service_id, network, result.get("status_code"))
     
     if result.get("status_code") == 200:
+        stock_cache.mark_available(service_id, network)
         data = result.get("data", {})
+        if data.get("balance") is not None:
+            balance_cache.update(data["balance"])
         return {
             "status": 1,
             "id": data.get("request_id"),
@@ -121,76 +1537,945 @@ def create_order(service_id, network=None):
         return {"status": 0, "message": "Dịch vụ không khả dụng"}
     elif result.get("status_code") == 429:
         return {"status": 0, "message": "Vượt quá giới hạn"}
+    elif result.get("status_code") == -5:
+        return {"status": 0, "message": "Nhà cung cấp đang gián đoạn, vui lòng thử lại sau ít phút"}
     else:
         return {"status": 0, "message": result.get("message", "Lỗi không xác định")}
 
-def check_order(request_id):
-    result = api_call("session/getv2", {"requestId": request_id})
+def parse_session(data):
+    if not isinstance(data, dict):
+        return None
+    try:
+        status = int(data.get("Status", 0))
+    except (TypeError, ValueError):
+        return None
     
+    if status == 1:
+        return {
+            "status": 1,
+            "code": data.get("Code"),
+            "is_sound": str(data.get("IsSound", "false")).lower() == "true"
+        }
+    elif status == 0:
+        return {"status": 1, "code": None, "waiting": True}
+    elif status == 2:
+        return {"status": 0, "message": "Hết thời gian"}
+    return None
+
+@traced("check_order")
+def check_order(request_id):
+    return session_result(api_call("session/getv2", {"requestId": request_id}))
+
+def session_result(result):
     if result.get("status_code") == 200:
-        data = result.get("data", {})
-        status = data.get("Status", 0)
-        
-        if status == 1:
-            return {
-                "status": 1,
-                "code": data.get("Code"),
-                "is_sound": data.get("IsSound", "false") == "true"
-            }
-        elif status == 0:
-            return {"status": 1, "code": None, "waiting": True}
-        elif status == 2:
-            return {"status": 0, "message": "Hết thời gian"}
+        parsed = parse_session(result.get("data") or {})
+        if parsed:
+            return parsed
+    elif result.get("status_code") in (-1, -5):
+        # Upstream unreachable or breaker open: keep waiting, OTP_TIMEOUT still applies.
+        return {"status": 1, "code": None, "waiting": True, "error": result.get("message")}
     
     return {"status": 0, "message": "Lỗi kiểm tra OTP"}
 
+# ==================== BALANCE CACHE ====================
+class BalanceCache:
+    # Concurrent misses share one upstream call; successful orders refresh
+    # the value for free since request/getv2 already returns the balance.
+    def __init__(self, fetch, ttl=BALANCE_TTL):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._value = None
+        self._updated = 0.0
+        self._inflight = None
+        self._last = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def update(self, balance):
+        with self._lock:
+            self._value = balance
+            self._updated = time.monotonic()
+
+    def fresh(self):
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._updated < self._ttl:
+                self.hits += 1
+                return {"status": 1, "balance": self._value}
+        return None
+
+    def get(self):
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._updated < self._ttl:
+                self.hits += 1
+                return {"status": 1, "balance": self._value}
+            event = self._inflight
+            leader = event is None
+            if leader:
+                self.misses += 1
+                event = self._inflight = threading.Event()
+            else:
+                self.coalesced += 1
+        if not leader:
+            event.wait(20)
+            return self._last or {"status": 0, "message": "Không lấy được số dư"}
+        result = {"status": 0, "message": "Không lấy được số dư"}
+        try:
+            result = self._fetch()
+        finally:
+            with self._lock:
+                if result.get("status") == 1:
+                    self._value = result["balance"]
+                    self._updated = time.monotonic()
+                self._last = result
+                self._inflight = None
+            event.set()
+        return result
+
+    def stats(self):
+        age = time.monotonic() - self._updated if self._value is not None else None
+        return {
+            "value": self._value,
+            "age": round(age, 1) if age is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+balance_cache = BalanceCache(fetch_balance)
+
+# ==================== ASYNC MODE ====================
+# Bot API methods the loop calls natively, with their positional parameters.
+# Anything else (send_document) runs on the loop's executor through telebot.
+ASYNC_TELEGRAM_METHODS = {
+    'send_message': ('sendMessage', ('chat_id', 'text')),
+    'edit_message_text': ('editMessageText', ('text', 'chat_id', 'message_id')),
+    'answer_callback_query': ('answerCallbackQuery', ('callback_query_id', 'text')),
+}
+
+class AsyncRuntime:
+    # Event loop on its own thread with one pooled aiohttp session. Threads
+    # hand work over with submit() and get a concurrent Future back, so a
+    # waiting order or an in-flight rent costs a coroutine, not a thread.
+    # SQLite work goes through blocking() to a small fixed executor so it
+    # never stalls the loop. asyncio and aiohttp are only imported here,
+    # which keeps them off the cold start when ASYNC_MODE is off.
+    def __init__(self, limit=ASYNC_HTTP_LIMIT, blocking_workers=ASYNC_BLOCKING_WORKERS):
+        self._limit = limit
+        self._blocking_workers = blocking_workers
+        self.loop = None
+        self.session = None
+        self._asyncio = None
+        self._aiohttp = None
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self.inflight = 0
+
+    def start(self):
+        try:
+            import aiohttp
+        except ImportError:
+            logger.error("❌ ASYNC_MODE needs aiohttp (pip install aiohttp), using threads")
+            return False
+        import asyncio
+        self._asyncio = asyncio
+        self._aiohttp = aiohttp
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(self._blocking_workers, thread_name_prefix="async-blocking"))
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), name="async-loop", daemon=True).start()
+        ready.wait()
+        logger.info("⚡ Async mode enabled")
+        return True
+
+    def _run(self, ready):
+        self._asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._open())
+        ready.set()
+        self.loop.run_forever()
+
+    async def _open(self):
+        connector = self._aiohttp.TCPConnector(limit=self._limit, keepalive_timeout=HTTP_KEEPALIVE_INTERVAL)
+        self.session = self._aiohttp.ClientSession(connector=connector)
+
+    def submit(self, coro):
+        with self._lock:
+            self.inflight += 1
+        future = self._asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self.inflight -= 1
+
+    def blocking(self, fn, *args):
+        return self.loop.run_in_executor(None, functools.partial(fn, *args))
+
+    def sleep(self, seconds):
+        return self._asyncio.sleep(seconds)
+
+    def shared(self, key, factory):
+        # Concurrent awaits of the same key share one task.
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            task = self._tasks[key] = self._asyncio.ensure_future(factory())
+        return self._asyncio.shield(task)
+
+    async def viotp(self, url, params, timeout):
+        kwargs = {"proxy": PROXY_URL} if USE_PROXY and PROXY_URL else {}
+        async with self.session.get(url, params={k: str(v) for k, v in params.items()},
+                                    headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"},
+                                    timeout=self._aiohttp.ClientTimeout(total=timeout), **kwargs) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def telegram(self, method, args, kwargs):
+        if method not in ASYNC_TELEGRAM_METHODS:
+            return await self.loop.run_in_executor(None, lambda: getattr(bot, method)(*args, **kwargs))
+        api_method, names = ASYNC_TELEGRAM_METHODS[method]
+        params = dict(zip(names, args))
+        params.update(kwargs)
+        markup = params.get('reply_markup')
+        if isinstance(markup, str):
+            params['reply_markup'] = json.loads(markup)
+        elif markup is not None:
+            params['reply_markup'] = json.loads(markup.to_json())
+        params = {k: v for k, v in params.items() if v is not None}
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            async with self.session.post(f"{telegram_base_url()}/bot{BOT_TOKEN}/{api_method}", json=params,
+                                         timeout=self._aiohttp.ClientTimeout(total=30)) as response:
+                result = await response.json(content_type=None)
+        except (self._aiohttp.ClientError, self._asyncio.TimeoutError) as e:
+            outcome = "error"
+            # Same retry handling as a dropped connection in threaded mode.
+            raise requests.ConnectionError(str(e)) from e
+        finally:
+            metrics.observe("telegram_request_seconds", time.monotonic() - started, method=api_method, result=outcome)
+        if not result.get("ok"):
+            metrics.inc("telegram_errors_total", method=api_method, result=str(result.get("error_code")))
+            raise telebot.apihelper.ApiTelegramException(api_method, None, result)
+        if isinstance(result.get("result"), dict) and "message_id" in result["result"]:
+            return types.Message.de_json(result["result"])
+        return result.get("result")
+
+    def stats(self):
+        return {"inflight": self.inflight, "http_limit": self._limit}
+
+async def async_api_call(endpoint, params=None, budget=API_BUDGET_BACKGROUND):
+    breaker = breakers[endpoint]
+    if not breaker.allow():
+        metrics.inc("viotp_errors_total", endpoint=endpoint, code="breaker_open")
+        return {"status_code": -5, "message": "Circuit open"}
+    
+    params = dict(params or {}, token=API_TOKEN)
+    url = f"{BASE_URL}/{endpoint}"
+    deadline = time.monotonic() + budget
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.monotonic()
+        code = "error"
+        status = None
+        try:
+            result = await async_runtime.viotp(url, params, max(0.5, min(15, deadline - started)))
+            code = str(result.get("status_code"))
+            breaker.record(True)
+            return result
+        except Exception as e:
+            error = e
+            status = getattr(e, 'status', None)
+            if status is not None:
+                code = f"http_{status}"
+        finally:
+            metrics.observe("viotp_request_seconds", time.monotonic() - started, endpoint=endpoint, code=code)
+            if code != "200":
+                metrics.inc("viotp_errors_total", endpoint=endpoint, code=code)
+        
+        backoff = api_backoff(endpoint, breaker, error, status, attempt, deadline)
+        if backoff is None:
+            return {"status_code": -1, "message": str(error)}
+        await async_runtime.sleep(backoff)
+
+async def async_fetch_balance():
+    return balance_result(await async_api_call("users/balance", budget=API_BUDGET_INTERACTIVE))
+
+async def async_get_balance():
+    # Same cache as get_balance; concurrent misses on the loop share one task.
+    cached = balance_cache.fresh()
+    if cached:
+        return cached
+    result = await async_runtime.shared("balance", async_fetch_balance)
+    if result.get("status") == 1:
+        balance_cache.update(result["balance"])
+    return result
+
+async def async_create_order(service_id, network=None, budget=API_BUDGET_INTERACTIVE):
+    result = await async_api_call("request/getv2", order_params(service_id, network), budget)
+    return order_result(result, service_id, network)
+
+async def async_check_order(request_id):
+    return session_result(await async_api_call("session/getv2", {"requestId": request_id}))
+
+async_runtime = AsyncRuntime() if ASYNC_MODE else None
+if async_runtime is not None and not async_runtime.start():
+    async_runtime = None
+
+# ==================== STOCK CACHE ====================
+STOCK_MESSAGES = {-3: "Kho số tạm hết", -4: "Dịch vụ không khả dụng"}
+
+class StockCache:
+    # Negative cache of (service id, network) pairs that just answered -3/-4.
+    # The TTL doubles on each repeated miss up to max_ttl, so a long outage
+    # costs one upstream call per window instead of one per tap.
+    def __init__(self, ttl=STOCK_TTL, max_ttl=STOCK_MAX_TTL):
+        self._ttl = ttl
+        self._max_ttl = max_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def mark_unavailable(self, service_id, network, code):
+        key = (str(service_id), network or 'any')
+        now = time.time()
+        with self._lock:
+            until, _, strikes = self._entries.get(key, (0, None, 0))
+            # A miss soon after the entry lapsed is the same outage and
+            # doubles the window; one after a longer gap than the lapsed
+            # window starts again from the base TTL.
+            if strikes and now - until > min(self._max_ttl, self._ttl * 2 ** (strikes - 1)):
+                strikes = 0
+            ttl = min(self._max_ttl, self._ttl * 2 ** strikes)
+            self._entries[key] = (now + ttl, code, strikes + 1)
+
+    def mark_available(self, service_id, network):
+        key = (str(service_id), network or 'any')
+        if key in self._entries:
+            with self._lock:
+                self._entries.pop(key, None)
+
+    def unavailable(self, service_id, network):
+        entry = self._entries.get((str(service_id), network or 'any'))
+        if entry and entry[0] > time.time():
+            return STOCK_MESSAGES.get(entry[1], "Kho số tạm hết")
+        return None
+
+    def blocked(self, service_id):
+        now = time.time()
+        return frozenset(network for (sid, network), (until, _, _) in list(self._entries.items())
+                         if sid == str(service_id) and until > now)
+
+    def expiring(self, within):
+        now = time.time()
+        return [key for key, (until, _, _) in list(self._entries.items()) if until - now <= within]
+
+    def stats(self):
+        now = time.time()
+        return {f"{sid}:{network}": round(until - now, 1)
+                for (sid, network), (until, _, _) in list(self._entries.items()) if until > now}
+
+def stock_refresher():
+    # Only runs with STOCK_PROBE_ENDPOINT: pairs about to expire are probed
+    # here and kept or cleared up front. Without it the only availability
+    # probe is a real rent, so entries just lapse and the next tap goes
+    # upstream again.
+    while True:
+        time.sleep(STOCK_TTL / 2)
+        try:
+            for service_id, network in stock_cache.expiring(STOCK_TTL / 2):
+                params = {"serviceId": service_id, "country": COUNTRY}
+                if network != 'any':
+                    params['network'] = network
+                result = api_call(STOCK_PROBE_ENDPOINT, params)
+                if result.get("status_code") == 200:
+                    stock_cache.mark_available(service_id, network)
+                elif result.get("status_code") in (-3, -4):
+                    stock_cache.mark_unavailable(service_id, network, result.get("status_code"))
+        except Exception as e:
+            logger.error("Stock refresher error: %s", e)
+
+stock_cache = StockCache()
+if STOCK_PROBE_ENDPOINT:
+    threading.Thread(target=stock_refresher, name="stock-refresher", daemon=True).start()
+
+# ==================== OTP SCHEDULER ====================
+class PendingCheck:
+    __slots__ = ('chat_id', 'request_id', 'phone', 'service_name', 'network_name',
+                 'service_id', 'network_code', 'polls', 'created_at', 'next_at', 'leased_at', 'trace')
+
+    def __init__(self, chat_id, request_id, phone, service_name, network_name,
+                 service_id=None, network_code=None, trace=None):
+        self.chat_id = chat_id
+        self.request_id = str(request_id)
+        self.phone = phone
+        self.service_name = service_name
+        self.network_name = network_name
+        self.service_id = service_id
+        self.network_code = network_code
+        self.polls = 0
+        self.created_at = time.time()
+        self.next_at = 0.0
+        self.leased_at = 0.0
+        self.trace = trace
+
+    def info(self):
+        return {
+            "request_id": self.request_id,
+            "chat_id": self.chat_id,
+            "phone": self.phone,
+            "network": self.network_name,
+            "polls": self.polls,
+            "age": round(time.time() - self.created_at, 1),
+            "next_poll_in": round(max(0.0, self.next_at - time.monotonic()), 1),
+        }
+
+class PollPolicy:
+    # Learns time-to-OTP per (service id, network) and spends polls where
+    # OTPs actually arrive: sparse before the window, dense inside it and
+    # backing off with jitter once it has passed.
+    def __init__(self, path=OTP_STATS_FILE, default_interval=OTP_POLL_INTERVAL,
+                 dense_interval=2.0, max_interval=20.0, min_samples=5, max_samples=200, floor=0.0):
+        self._path = path
+        self._floor = floor
+        self._default = default_interval
+        self._dense = dense_interval
+        self._max = max_interval
+        self._min_samples = min_samples
+        self._max_samples = max_samples
+        self._samples = {}
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = 0.0
+        self.load()
+
+    @staticmethod
+    def key(service_id, network):
+        return f"{service_id}:{network or 'any'}"
+
+    def record(self, service_id, network, seconds):
+        key = self.key(service_id, network)
+        with self._lock:
+            samples = self._samples.setdefault(key, [])
+            samples.append(round(seconds, 1))
+            del samples[:-self._max_samples]
+            self._windows.pop(key, None)
+            self._dirty = True
+        if time.time() - self._saved_at > 30:
+            self.save()
+
+    def window(self, service_id, network):
+        key = self.key(service_id, network)
+        window = self._windows.get(key)
+        if window is None:
+            with self._lock:
+                samples = sorted(self._samples.get(key, ()))
+            if len(samples) < self._min_samples:
+                return None
+            window = (samples[int(len(samples) * 0.1)], samples[int(len(samples) * 0.9)])
+            self._windows[key] = window
+        return window
+
+    def next_delay(self, check):
+        return max(self._floor, self._learned_delay(check))
+
+    def _learned_delay(self, check):
+        window = self.window(check.service_id, check.network_code)
+        if window is None:
+            return self._default
+        lo, hi = window
+        elapsed = time.time() - check.created_at
+        if elapsed < lo:
+            return min(self._max, max(self._dense, lo - elapsed))
+        if elapsed <= hi:
+            return self._dense
+        backoff = min(self._max, max(self._dense, (elapsed - hi) / 2))
+        return backoff * random.uniform(0.8, 1.2)
+
+    def stats(self):
+        with self._lock:
+            keys = list(self._samples)
+        return {key: {"samples": len(self._samples[key]), "window": self.window(*key.split(':', 1))}
+                for key in keys}
+
+    def load(self):
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+            self._samples = {k: [float(x) for x in v][-self._max_samples:] for k, v in data.items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"OTP stats load error: {e}")
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {k: list(v) for k, v in self._samples.items()}
+            self._dirty = False
+            self._saved_at = time.time()
+        try:
+            tmp = f"{self._path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self._path)
+        except Exception as e:
+            logger.error(f"OTP stats save error: {e}")
+
+OTP_EXPIRED = {"status": 0, "message": "Hết thời gian"}
+
+class OtpScheduler:
+    # One timer thread walks a deadline heap and hands due checks to a fixed
+    # worker pool, so the thread count does not grow with pending orders.
+    # Each pending check holds a lease in the shared state; a check whose
+    # lease cannot be renewed belongs to another worker and is dropped here.
+    def __init__(self, poll, policy, state, workers=OTP_WORKERS, timeout=OTP_TIMEOUT, async_poll=None):
+        self._poll = poll
+        self._async_poll = async_poll
+        self._async = async_runtime is not None and async_poll is not None
+        self._policy = policy
+        self._state = state
+        self._workers = workers
+        self._timeout = timeout
+        self._heap = []
+        self._pending = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._jobs = queue.Queue()
+        self._started = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, request_id):
+        return request_id in self._pending
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._timer_loop, name="otp-timer", daemon=True).start()
+        if self._async:
+            return
+        for i in range(self._workers):
+            threading.Thread(target=self._worker_loop, name=f"otp-worker-{i}", daemon=True).start()
+
+    def schedule(self, check, delay=None):
+        if check.request_id in self._pending:
+            return False
+        if not self._state.acquire(check.request_id, WORKER_ID, LEASE_TTL):
+            return False
+        check.leased_at = time.monotonic()
+        # Counts against the chat's ORDERS_MAX_WAITING in every worker.
+        self._state.take_slot(waiting_slots(check.chat_id), check.request_id, WORKER_ID,
+                              self._timeout + LEASE_TTL, replace=True)
+        with self._cond:
+            if check.request_id in self._pending:
+                return False
+            self._pending[check.request_id] = check
+            self._push(check, self._policy.next_delay(check) if delay is None else delay)
+        self.start()
+        return True
+
+    def cancel(self, request_id):
+        with self._cond:
+            check = self._pending.pop(request_id, None)
+        if check is not None:
+            self._release_slot(check)
+            self._state.release(request_id, WORKER_ID)
+        return check is not None
+
+    def claim(self, check):
+        # Whoever claims a check first (a poll or a pushed callback) is the
+        # one that delivers its result. The lease stays held until the
+        # caller has committed the order's new status and calls release(),
+        # so no reaper can pick the order up as still waiting in between.
+        with self._cond:
+            if self._pending.get(check.request_id) is not check:
+                return False
+            del self._pending[check.request_id]
+        self._release_slot(check)
+        return True
+
+    def release(self, request_id):
+        self._state.release(request_id, WORKER_ID)
+
+    def _release_slot(self, check):
+        self._state.release_slot(waiting_slots(check.chat_id), check.request_id, WORKER_ID)
+
+    def push(self, request_id, result):
+        # Only delivered while this worker still holds the lease.
+        check = self._pending.get(request_id)
+        if check is None or not self._lease(check):
+            return False
+        return self._poll(check, result)
+
+    def postpone(self, request_id, delay):
+        # Moves the next poll later; the old heap entry is skipped as stale.
+        # A postponed check is not polled, so its lease is renewed here.
+        check = self._pending.get(request_id)
+        if check is None:
+            return
+        if time.monotonic() - check.leased_at > LEASE_TTL / 2 and not self._lease(check):
+            return
+        with self._cond:
+            if self._pending.get(request_id) is check and check.next_at < time.monotonic() + delay:
+                self._push(check, delay)
+
+    def pending_ids(self):
+        with self._cond:
+            return set(self._pending)
+
+    def get(self, request_id):
+        check = self._pending.get(request_id)
+        return check.info() if check else None
+
+    def pending(self):
+        with self._cond:
+            checks = list(self._pending.values())
+        return sorted((c.info() for c in checks), key=lambda i: i["next_poll_in"])
+
+    def _push(self, check, delay):
+        check.next_at = time.monotonic() + delay
+        heapq.heappush(self._heap, (check.next_at, next(self._seq), check))
+        self._cond.notify()
+
+    def _timer_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    due, _, check = self._heap[0]
+                    wait = due - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    heapq.heappop(self._heap)
+                    if self._pending.get(check.request_id) is check and due >= check.next_at:
+                        break
+            if self._async:
+                async_runtime.submit(self._run_async(check))
+            else:
+                self._jobs.put(check)
+
+    def _worker_loop(self):
+        while True:
+            check = self._jobs.get()
+            if not self._renew(check):
+                continue
+            try:
+                done = self._poll(check)
+            except Exception as e:
+                logger.error("Auto check error: %s", e,
+                             extra={"order_id": check.request_id, "chat_id": check.chat_id})
+                done = True
+            self._finish(check, done)
+
+    async def _run_async(self, check):
+        # Leases and the order store are SQLite, so only the upstream call
+        # itself stays on the loop.
+        if not await async_runtime.blocking(self._renew, check):
+            return
+        try:
+            done = await self._async_poll(check)
+        except Exception as e:
+            logger.error("Auto check error: %s", e,
+                         extra={"order_id": check.request_id, "chat_id": check.chat_id})
+            done = True
+        await async_runtime.blocking(self._finish, check, done)
+
+    def _renew(self, check):
+        check.polls += 1
+        try:
+            return self._lease(check)
+        except Exception as e:
+            logger.error("Auto check error: %s", e,
+                         extra={"order_id": check.request_id, "chat_id": check.chat_id})
+            self._finish(check, True)
+            return False
+
+    def _lease(self, check):
+        if self._state.acquire(check.request_id, WORKER_ID, LEASE_TTL):
+            check.leased_at = time.monotonic()
+            return True
+        logger.info("Lease taken over, dropping local check", extra={"order_id": check.request_id})
+        self.cancel(check.request_id)
+        return False
+
+    def _finish(self, check, done):
+        with self._cond:
+            if self._pending.get(check.request_id) is not check:
+                return
+            remaining = check.created_at + self._timeout - time.time()
+            if not done and remaining > 0:
+                self._push(check, min(self._policy.next_delay(check), remaining))
+                return
+            if done:
+                del self._pending[check.request_id]
+        if not done:
+            self._expire(check)
+            return
+        self._release_slot(check)
+        self._state.release(check.request_id, WORKER_ID)
+
+    def _expire(self, check):
+        # Settled as a timeout like an expired session, so the order does not
+        # stay waiting and get polled again on every resume.
+        try:
+            self._poll(check, OTP_EXPIRED)
+        except Exception as e:
+            logger.error("Auto check error: %s", e,
+                         extra={"order_id": check.request_id, "chat_id": check.chat_id})
+            self.cancel(check.request_id)
+
 # ==================== AUTO CHECK OTP ====================
-def auto_check_otp(chat_id, request_id, phone, service_name, network_name):
-    key = f"{chat_id}_{request_id}"
-    if key in active_checks:
-        return
-    active_checks[key] = True
-    try:
-        for _ in range(120):
-            time.sleep(3)
-            result = check_order(request_id)
-            if result.get("status") == 1 and result.get("code"):
-                code = result["code"]
-                is_sound = result.get("is_sound", False)
-                
-                msg = (
-                    f"✅ <b>OTP ĐÃ VỀ!</b>\n\n"
-                    f"🎰 <b>OKVIP</b>\n"
-                    f"📞 <b>Số:</b> <code>{phone}</code>\n"
-                    f"📶 <b>Nhà mạng:</b> {network_name}\n\n"
-                    f"🔑 <b>MÃ OTP:</b> <code>{code}</code>\n\n"
-                    f"⏰ {datetime.now().strftime('%H:%M:%S')}"
-                )
-                
-                if is_sound:
-                    msg += f"\n📞 <i>(Nhận qua cuộc gọi)</i>"
-                
-                bot.send_message(chat_id, msg, parse_mode="HTML")
-                user_orders[chat_id][request_id]['status'] = 'completed'
-                user_orders[chat_id][request_id]['otp'] = code
-                break
-            elif result.get("status") == 0:
-                bot.send_message(chat_id, 
-                    f"⏰ <b>HẾT THỜI GIAN CHỜ OTP</b>\n\n"
-                    f"🎰 <b>OKVIP</b>\n"
-                    f"📞 <b>Số:</b> <code>{phone}</code>\n"
-                    f"📶 <b>Nhà mạng:</b> {network_name}",
-                    parse_mode="HTML"
-                )
-                user_orders[chat_id][request_id]['status'] = 'timeout'
-                break
-    except Exception as e:
-        logger.error(f"Auto check error: {e}")
-    finally:
-        active_checks.pop(key, None)
+def auto_check_otp(check, result=None):
+    with tracer.span("otp_check", parent=check.trace, order_id=check.request_id,
+                     poll=check.polls, pushed=result is not None):
+        return check_and_deliver(check, result)
+
+async def auto_check_otp_async(check):
+    started = time.time()
+    result = await async_check_order(check.request_id)
+    return await async_runtime.blocking(deliver_polled, check, result, time.time() - started)
+
+def deliver_polled(check, result, elapsed):
+    with tracer.span("otp_check", parent=check.trace, order_id=check.request_id, poll=check.polls,
+                     pushed=False, check_ms=round(elapsed * 1000, 1)):
+        return check_and_deliver(check, result)
+
+def check_and_deliver(check, result):
+    chat_id = check.chat_id
+    request_id = check.request_id
+    phone = check.phone
+    network_name = check.network_name
+
+    if result is None:
+        result = check_order(request_id)
+    if result.get("status") == 1 and result.get("code"):
+        if not otp_scheduler.claim(check):
+            return True
+        code = result["code"]
+        is_sound = result.get("is_sound", False)
+        
+        msg = (
+            f"✅ <b>OTP ĐÃ VỀ!</b>\n\n"
+            f"🎰 <b>OKVIP</b>\n"
+            f"📞 <b>Số:</b> <code>{phone}</code>\n"
+            f"📶 <b>Nhà mạng:</b> {network_name}\n\n"
+            f"🔑 <b>MÃ OTP:</b> <code>{code}</code>\n\n"
+            f"⏰ {datetime.now().strftime('%H:%M:%S')}"
+        )
+        
+        if is_sound:
+            msg += f"\n📞 <i>(Nhận qua cuộc gọi)</i>"
+        
+        send_message(chat_id, msg, priority=PRIORITY_OTP, parse_mode="HTML")
+        waited = time.time() - check.created_at
+        poll_policy.record(check.service_id, check.network_code, waited)
+        metrics.observe("otp_wait_seconds", waited, service=check.service_id, network=check.network_code)
+        order_store.update(request_id, status='completed', otp=code,
+                           on_commit=lambda: otp_scheduler.release(request_id))
+        return True
+    elif result.get("status") == 0:
+        if not otp_scheduler.claim(check):
+            return True
+        send_message(chat_id, 
+            f"⏰ <b>HẾT THỜI GIAN CHỜ OTP</b>\n\n"
+            f"🎰 <b>OKVIP</b>\n"
+            f"📞 <b>Số:</b> <code>{phone}</code>\n"
+            f"📶 <b>Nhà mạng:</b> {network_name}",
+            priority=PRIORITY_OTP,
+            parse_mode="HTML"
+        )
+        order_store.update(request_id, status='timeout', on_commit=lambda: otp_scheduler.release(request_id))
+        return True
+    return False
+
+poll_policy = PollPolicy(floor=OTP_FALLBACK_INTERVAL if OTP_CALLBACK_SECRET else 0.0)
+atexit.register(poll_policy.save)
+otp_scheduler = OtpScheduler(auto_check_otp, poll_policy, state, async_poll=auto_check_otp_async)
+
+metrics.gauge("otp_checks_pending", "OTP checks scheduled in this worker", lambda: len(otp_scheduler))
+metrics.gauge("otp_checks_active", "OTP checks holding a lease across all workers", lambda: state.active_count())
+metrics.gauge("threads_live", "Live threads in this process", threading.active_count)
+metrics.gauge("webhook_backlog", "Updates waiting in the update queue", lambda: len(update_queue))
+metrics.histogram("update_wait_seconds", "Time updates spend queued before a worker picks them up")
+metrics.counter("updates_shed_total", "Updates rejected because the queue was full")
+metrics.counter("taps_deduplicated_total", "Button taps answered at once because the same tap was still in flight")
+metrics.gauge("outbound_queue_depth", "Telegram sends and edits waiting to go out", lambda: len(outbound))
+metrics.histogram("outbound_wait_seconds", "Time outgoing Telegram calls wait for a rate-limit slot")
+metrics.counter("telegram_429_total", "Telegram 429 responses honoured with retry_after")
+metrics.counter("telegram_edits_merged_total", "Pending message edits replaced by a newer edit")
+metrics.counter("stock_fast_fail_total", "Rent taps answered from the out-of-stock cache")
+metrics.counter("otp_push_total", "OTP callbacks received, by outcome")
+metrics.counter("reconcile_calls_total", "Request history pages fetched to reconcile pending orders")
+metrics.counter("reconcile_settled_total", "Pending orders settled from the request history")
+
+def reconcile_pending():
+    pending = otp_scheduler.pending_ids()
+    settled = 0
+    page = 1
+    while pending and page <= RECONCILE_MAX_PAGES:
+        result = api_call(RECONCILE_ENDPOINT, {"limit": RECONCILE_PAGE_SIZE, "page": page})
+        metrics.inc("reconcile_calls_total")
+        if result.get("status_code") != 200:
+            break
+        items = result.get("data") or []
+        if isinstance(items, dict):
+            items = items.get("items") or items.get("data") or []
+        for item in items:
+            request_id = str(item.get("RequestId") or item.get("requestId") or item.get("request_id") or "")
+            if request_id not in pending:
+                continue
+            pending.discard(request_id)
+            parsed = parse_session(item)
+            if parsed is None:
+                continue
+            if parsed.get("waiting"):
+                otp_scheduler.postpone(request_id, OTP_FALLBACK_INTERVAL)
+            elif otp_scheduler.push(request_id, parsed):
+                settled += 1
+        if len(items) < RECONCILE_PAGE_SIZE:
+            break
+        page += 1
+    if settled:
+        metrics.inc("reconcile_settled_total", settled)
+    return settled
+
+def reconciler():
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        try:
+            reconcile_pending()
+        except Exception as e:
+            logger.error("Reconcile error: %s", e, extra={"sample_key": ("reconcile",)})
+
+def pending_check(order):
+    check = PendingCheck(
+        order.chat_id, order.request_id, order.phone, order.service, order.network,
+        service_id=order.service_id, network_code=order.network_code
+    )
+    check.created_at = order.created_ts
+    return check
+
+def resume_pending_orders():
+    resumed = 0
+    for order in order_store.waiting():
+        if order.request_id in otp_scheduler:
+            continue
+        check = pending_check(order)
+        if otp_scheduler.schedule(check, delay=0 if time.time() - check.created_at >= OTP_TIMEOUT else None):
+            resumed += 1
+    if resumed:
+        logger.info(f"♻️ Resumed {resumed} pending OTP checks")
+
+def lease_reaper():
+    while True:
+        time.sleep(LEASE_TTL / 2)
+        try:
+            resume_pending_orders()
+        except Exception as e:
+            logger.error("Lease reaper error: %s", e)
+
+# ==================== ROUTER ====================
+CALLBACK_VERSION = "1"
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+def rent_data(service_key, network_code):
+    return f"{CALLBACK_VERSION}r{SERVICES[service_key]['id']}{NETWORK_TAGS[network_code]}"
+
+def orders_data(page):
+    return f"{CALLBACK_VERSION}o{page}"
+
+class Router:
+    # Dispatch tables built once at import instead of telebot's linear scan
+    # of handler predicates. Button texts and commands are dict lookups.
+    # Callback data is either matched whole or by its version+tag prefix,
+    # and the old "rent_<svc>_<net>" / "orders_<n>" data from keyboards
+    # already sitting in chats still resolves.
+    def __init__(self):
+        self._texts = {}
+        self._commands = {}
+        self._exact = {}
+        self._tags = {}
+        self._legacy = {}
+
+    def text(self, *texts):
+        def decorator(fn):
+            for text in texts:
+                self._texts[text] = fn
+            return fn
+        return decorator
+
+    def command(self, *names):
+        def decorator(fn):
+            for name in names:
+                self._commands[name] = fn
+            return fn
+        return decorator
+
+    def callback(self, tag, legacy=None):
+        # fn(call, rest) gets whatever follows the version and tag.
+        def decorator(fn):
+            self._tags[CALLBACK_VERSION + tag] = fn
+            if legacy:
+                self._legacy[legacy] = fn
+            return fn
+        return decorator
+
+    def callback_data(self, data, fn, *args):
+        self._exact[data] = (fn, args)
+
+    def dispatch(self, update):
+        if update.message is not None:
+            return self.dispatch_message(update.message)
+        elif update.callback_query is not None:
+            return self.dispatch_callback(update.callback_query)
+
+    def dispatch_message(self, message):
+        text = message.text
+        if not text:
+            return
+        handler = self._texts.get(text)
+        if handler is None and text[0] == '/':
+            parts = text[1:].split(None, 1)
+            if parts:
+                handler = self._commands.get(parts[0].split('@', 1)[0])
+        if handler is not None:
+            return handler(message)
+
+    def dispatch_callback(self, call):
+        data = call.data or ""
+        entry = self._exact.get(data)
+        if entry is not None:
+            return entry[0](call, *entry[1])
+        handler = self._tags.get(data[:2])
+        if handler is not None:
+            return handler(call, data[2:])
+        tag, _, rest = data.partition('_')
+        handler = self._legacy.get(tag)
+        if handler is not None:
+            return handler(call, rest)
+
+router = Router()
+
+def wanted(payload):
+    # Checked on the raw JSON so updates nothing handles never get de_json'd.
+    message = payload.get("message")
+    if message is not None:
+        return bool(message.get("text"))
+    return "callback_query" in payload
 
 # ==================== KEYBOARDS ====================
-def get_main_keyboard():
+# Markups are serialized once at import; telebot passes JSON strings through as-is.
+def build_main_keyboard():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     kb.row(
         types.KeyboardButton("📱 OKVIP1"),
@@ -202,19 +2487,34 @@ def get_main_keyboard():
     )
     return kb
 
-def get_network_keyboard(service_key):
+def build_network_keyboard(service_key, blocked=frozenset()):
     kb = types.InlineKeyboardMarkup(row_width=2)
     
     for network_code, network_name in NETWORKS.items():
+        if network_code in blocked:
+            network_name = f"⛔ {network_name} (hết số)"
         kb.add(types.InlineKeyboardButton(
             network_name,
-            callback_data=f"rent_{service_key}_{network_code}"
+            callback_data=rent_data(service_key, network_code)
         ))
     
     return kb
 
+MAIN_KEYBOARD = build_main_keyboard().to_json()
+NETWORK_KEYBOARDS = {(key, frozenset()): build_network_keyboard(key).to_json() for key in SERVICES}
+
+def get_main_keyboard():
+    return MAIN_KEYBOARD
+
+def get_network_keyboard(service_key):
+    cache_key = (service_key, stock_cache.blocked(SERVICES[service_key]['id']))
+    kb = NETWORK_KEYBOARDS.get(cache_key)
+    if kb is None:
+        kb = NETWORK_KEYBOARDS[cache_key] = build_network_keyboard(*cache_key).to_json()
+    return kb
+
 # ==================== BOT HANDLERS ====================
-@bot.message_handler(commands=['start'])
+@router.command('start')
 def cmd_start(message):
     text = (
         "✨ <b>CHÀO MỪNG ĐẾN OKVIP BOT</b>\n\n"
@@ -222,54 +2522,67 @@ def cmd_start(message):
         "⚡ Nhanh chóng - Tiện lợi\n\n"
         "👇 <b>Chọn dịch vụ:</b>"
     )
-    bot.send_message(message.chat.id, text, reply_markup=get_main_keyboard(), parse_mode="HTML")
-    logger.info(f"User {message.chat.id} started bot")
+    send_message(message.chat.id, text, reply_markup=get_main_keyboard(), parse_mode="HTML")
+    logger.info("User started bot", extra={"chat_id": message.chat.id})
 
-@bot.message_handler(func=lambda m: m.text in ["📱 OKVIP1", "OKVIP1"])
+@router.text("📱 OKVIP1", "OKVIP1")
 def cmd_okvip1(message):
     text = (
         f"🎰 <b>OKVIP</b>\n\n"
         f"📶 <b>Chọn nhà mạng:</b>"
     )
-    bot.send_message(message.chat.id, text, reply_markup=get_network_keyboard('okvip1'), parse_mode="HTML")
+    send_message(message.chat.id, text, reply_markup=get_network_keyboard('okvip1'), parse_mode="HTML")
 
-@bot.message_handler(func=lambda m: m.text in ["📱 OKVIP2", "OKVIP2"])
+@router.text("📱 OKVIP2", "OKVIP2")
 def cmd_okvip2(message):
     text = (
         f"🎰 <b>OKVIP</b>\n\n"
         f"📶 <b>Chọn nhà mạng:</b>"
     )
-    bot.send_message(message.chat.id, text, reply_markup=get_network_keyboard('okvip2'), parse_mode="HTML")
+    send_message(message.chat.id, text, reply_markup=get_network_keyboard('okvip2'), parse_mode="HTML")
 
-@bot.message_handler(func=lambda m: m.text in ["📦 Đơn hàng"])
-def cmd_orders(message):
-    orders = user_orders.get(message.chat.id)
-    if not orders:
-        bot.reply_to(message, "📭 <b>Chưa có đơn hàng</b>", parse_mode="HTML")
-        return
+def render_orders(chat_id, page=0):
+    total = order_store.count(chat_id)
+    if not total:
+        return "📭 <b>Chưa có đơn hàng</b>", None
     
-    recent = list(orders.items())[-10:]
-    recent.reverse()
+    pages = (total + ORDERS_PAGE_SIZE - 1) // ORDERS_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    recent = order_store.recent(chat_id, ORDERS_PAGE_SIZE, page * ORDERS_PAGE_SIZE)
     
-    text = "📋 <b>ĐƠN HÀNG</b>\n\n"
+    text = f"📋 <b>ĐƠN HÀNG</b> ({page + 1}/{pages})\n\n"
     
-    for req_id, info in recent:
-        status = info.get('status', 'unknown')
-        icon = {'completed': '✅', 'waiting': '⏳', 'timeout': '⌛'}.get(status, '❓')
-        status_text = {'completed': 'Đã nhận OTP', 'waiting': 'Đang chờ', 'timeout': 'Hết hạn'}.get(status, 'Không rõ')
+    for order in recent:
+        icon = {'completed': '✅', 'waiting': '⏳', 'timeout': '⌛'}.get(order.status, '❓')
+        status_text = {'completed': 'Đã nhận OTP', 'waiting': 'Đang chờ', 'timeout': 'Hết hạn'}.get(order.status, 'Không rõ')
         
-        text += f"{icon} <b>{info.get('service')}</b> - {status_text}\n"
-        text += f"📞 <code>{info.get('phone')}</code>\n"
-        text += f"📶 {info.get('network')}\n"
+        text += f"{icon} <b>{order.service}</b> - {status_text}\n"
+        text += f"📞 <code>{order.phone}</code>\n"
+        text += f"📶 {order.network}\n"
         
-        if info.get('otp'):
-            text += f"🔑 <code>{info.get('otp')}</code>\n"
+        if order.otp:
+            text += f"🔑 <code>{order.otp}</code>\n"
         
-        text += f"⏰ {info.get('created_at')}\n\n"
+        text += f"⏰ {order.created_at}\n\n"
     
-    bot.reply_to(message, text, parse_mode="HTML")
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton("◀️ Mới hơn", callback_data=orders_data(page - 1)))
+    if page < pages - 1:
+        buttons.append(types.InlineKeyboardButton("Cũ hơn ▶️", callback_data=orders_data(page + 1)))
+    kb = None
+    if buttons:
+        kb = types.InlineKeyboardMarkup()
+        kb.row(*buttons)
+        kb = kb.to_json()
+    return text, kb
 
-@bot.message_handler(func=lambda m: m.text in ["❓ Hướng dẫn"])
+@router.text("📦 Đơn hàng")
+def cmd_orders(message):
+    text, kb = render_orders(message.chat.id)
+    reply_to(message, text, parse_mode="HTML", reply_markup=kb)
+
+@router.text("❓ Hướng dẫn")
 def cmd_help(message):
     text = (
         "❓ <b>HƯỚNG DẪN SỬ DỤNG</b>\n\n"
@@ -287,58 +2600,137 @@ def cmd_help(message):
         "Mobifone, Vinaphone, Viettel\n"
         "Vietnamobile, ITelecom, Wintel"
     )
-    bot.reply_to(message, text, parse_mode="HTML")
+    reply_to(message, text, parse_mode="HTML")
 
-@bot.message_handler(commands=['balance'])
+@router.command('profile')
+def cmd_profile(message):
+    if not ADMIN_ID or str(message.chat.id) != str(ADMIN_ID):
+        reply_to(message, "❌ Không có quyền", parse_mode="HTML")
+        return
+    parts = message.text.split()
+    seconds = min(PROFILE_MAX_SECONDS, max(1, int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10))
+    reply_to(message, f"⏱️ Đang lấy mẫu {seconds}s...", parse_mode="HTML")
+    threading.Thread(target=send_profile, args=(message.chat.id, seconds), name="profiler", daemon=True).start()
+
+def send_profile(chat_id, seconds):
+    result = profiler.run(seconds)
+    if result is None:
+        send_message(chat_id, "⏳ Đang có một phiên profile khác chạy", parse_mode="HTML")
+        return
+    samples, dump = result
+    # Raw bytes rather than a stream, so a retried send uploads the whole file again.
+    outbound.submit(PRIORITY_REPLY, chat_id, 'send_document', chat_id, dump.encode('utf-8'),
+                    visible_file_name=f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded",
+                    caption=f"{samples} mẫu trong {seconds}s (collapsed stacks, dùng flamegraph.pl hoặc speedscope)")
+
+@router.command('balance')
 def cmd_balance(message):
-    result = get_balance()
+    if async_runtime is not None:
+        return async_runtime.submit(balance_async(message))
+    reply_balance(message, get_balance())
+
+async def balance_async(message):
+    reply_balance(message, await async_get_balance())
+
+def reply_balance(message, result):
     if result["status"] == 1:
         if ADMIN_ID and str(message.chat.id) == str(ADMIN_ID):
-            bot.reply_to(message, f"💰 <b>Số dư:</b> ${result['balance']:,.2f}", parse_mode="HTML")
+            reply_to(message, f"💰 <b>Số dư:</b> ${result['balance']:,.2f}", parse_mode="HTML")
         else:
-            bot.reply_to(message, "❌ Không có quyền xem số dư", parse_mode="HTML")
+            reply_to(message, "❌ Không có quyền xem số dư", parse_mode="HTML")
     else:
-        bot.reply_to(message, f"❌ {result['message']}", parse_mode="HTML")
+        reply_to(message, f"❌ {result['message']}", parse_mode="HTML")
 
 # ==================== CALLBACK HANDLERS ====================
-@bot.callback_query_handler(func=lambda call: call.data.startswith('rent_'))
-def callback_rent(call):
-    parts = call.data.split('_')
-    service_key = parts[1]
-    network_code = parts[2]
+@traced("callback_rent")
+def callback_rent(call, service_key, network_code):
+    started = time.monotonic()
     
     service = SERVICES[service_key]
     network_name = NETWORKS.get(network_code, network_code)
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
     
-    bot.answer_callback_query(call.id, "Đang xử lý...")
+    unavailable = stock_cache.unavailable(service['id'], network_code)
+    if unavailable:
+        metrics.inc("stock_fast_fail_total")
+        answer_callback(call.id, f"❌ {unavailable} ({network_name}), vui lòng chọn nhà mạng khác")
+        return
     
-    try:
-        bot.edit_message_text(
-            f"🎰 <b>OKVIP</b>\n\n"
-            f"⏳ <b>Đang tìm số...</b>\n"
-            f"📶 <b>Nhà mạng:</b> {network_name}",
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode="HTML"
-        )
-    except:
-        pass
+    # The cap is checked and a slot reserved in one step of the shared state,
+    # so taps of one chat handled by different workers cannot both get past
+    # it. The reservation is dropped once the order holds its own slot.
+    if ORDERS_MAX_WAITING and not state.take_slot(waiting_slots(chat_id), rent_slot(call), WORKER_ID,
+                                                  LEASE_TTL, limit=ORDERS_MAX_WAITING):
+        waiting = state.slot_count(waiting_slots(chat_id))
+        metrics.inc("rent_rejected_total", reason="max_waiting")
+        answer_callback(call.id, f"⚠️ Bạn đang có {waiting} đơn chờ OTP, vui lòng đợi OTP về rồi thuê tiếp")
+        return
     
-    msg = call.message
+    # The answer and the placeholder go out through the dispatcher while
+    # create_order runs. The final edit of the same message is merged into
+    # the placeholder if it has not left yet, or queued behind it.
+    rent_phase(answer_callback(call.id, "Đang xử lý..."), "answer", started)
+    rent_phase(edit_message_text(
+        f"🎰 <b>OKVIP</b>\n\n"
+        f"⏳ <b>Đang tìm số...</b>\n"
+        f"📶 <b>Nhà mạng:</b> {network_name}",
+        chat_id,
+        message_id,
+        parse_mode="HTML"
+    ), "placeholder", started)
     
-    result = create_order(service['id'], network=network_code)
+    # In async mode create_order runs as a coroutine and the chat stays busy
+    # in the update queue until the returned future settles.
+    if async_runtime is not None:
+        return async_runtime.submit(rent_async(call, service_key, network_code, started, tracer.current()))
+    try:
+        result = create_order(service['id'], network=network_code, budget=rent_budget(started))
+        rent_finish(call, service_key, network_code, result, started)
+    finally:
+        state.release_slot(waiting_slots(chat_id), rent_slot(call), WORKER_ID)
+
+async def rent_async(call, service_key, network_code, started, trace):
+    result = await async_create_order(SERVICES[service_key]['id'], network=network_code,
+                                      budget=rent_budget(started))
+    # Storing the order and taking its lease are SQLite writes, kept off the loop.
+    await async_runtime.blocking(rent_settle, call, service_key, network_code, result, started, trace)
+
+def rent_settle(call, service_key, network_code, result, started, trace):
+    try:
+        with tracer.span("rent_finish", parent=trace):
+            rent_finish(call, service_key, network_code, result, started)
+    finally:
+        state.release_slot(waiting_slots(call.message.chat.id), rent_slot(call), WORKER_ID)
+
+def rent_slot(call):
+    return f"rent:{call.id}"
+
+def rent_budget(started):
+    # The user is watching the placeholder: the rent gets what is left of
+    # the interactive budget since the tap was picked up.
+    return max(1.0, API_BUDGET_INTERACTIVE - (time.monotonic() - started))
+
+def rent_finish(call, service_key, network_code, result, started):
+    metrics.observe("rent_phase_seconds", time.monotonic() - started, phase="create_order")
+    service = SERVICES[service_key]
+    network_name = NETWORKS.get(network_code, network_code)
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
     
     if result["status"] == 1:
         req_id = result["id"]
         phone = result["phone"]
         
-        user_orders[call.message.chat.id][req_id] = {
-            'phone': phone,
-            'service': 'OKVIP',
-            'network': network_name,
-            'status': 'waiting',
-            'created_at': datetime.now().strftime('%H:%M:%S %d/%m')
-        }
+        order_store.add(Order(req_id, chat_id, phone, 'OKVIP', service['id'], network_code))
+        tracer.annotate(order_id=req_id, network=network_code)
+        
+        # Without push or reconciliation, poll right away; the policy spaces
+        # out the following ones.
+        otp_scheduler.schedule(PendingCheck(
+            chat_id, req_id, phone, 'OKVIP', network_name,
+            service_id=service['id'], network_code=network_code, trace=tracer.current()
+        ), delay=None if OTP_CALLBACK_SECRET or RECONCILE_ENDPOINT else 0)
         
         text = (
             f"🎉 <b>THUÊ THÀNH CÔNG!</b>\n\n"
@@ -349,31 +2741,194 @@ def callback_rent(call):
             f"⚡ <b>Đang chờ OTP tự động...</b>"
         )
         
-        bot.edit_message_text(text, call.message.chat.id, msg.message_id, parse_mode="HTML")
-        
-        threading.Thread(
-            target=auto_check_otp,
-            args=(call.message.chat.id, req_id, phone, 'OKVIP', network_name),
-            daemon=True
-        ).start()
+        rent_phase(edit_message_text(text, chat_id, message_id, parse_mode="HTML"), "number", started)
         
-        logger.info(f"Order: {req_id} - {phone} - OKVIP - {network_name}")
+        logger.info("Order: %s - %s - OKVIP - %s in %.2fs", req_id, phone, network_code,
+                    time.monotonic() - started, extra={"order_id": req_id, "chat_id": chat_id})
     else:
-        bot.edit_message_text(
+        rent_phase(edit_message_text(
             f"🎰 <b>OKVIP</b>\n\n"
             f"❌ <b>THUÊ SỐ THẤT BẠI</b>\n\n"
             f"<b>Lý do:</b> {result['message']}\n"
             f"📶 <b>Nhà mạng:</b> {network_name}\n\n"
             f"💡 Vui lòng thử lại sau",
-            call.message.chat.id,
-            msg.message_id,
+            chat_id,
+            message_id,
             parse_mode="HTML"
-        )
+        ), "failed", started)
+
+def rent_phase(future, phase, started):
+    future.add_done_callback(
+        lambda f: metrics.observe("rent_phase_seconds", time.monotonic() - started, phase=phase))
+
+for service_key in SERVICES:
+    for network_code in NETWORKS:
+        router.callback_data(rent_data(service_key, network_code), callback_rent, service_key, network_code)
+        router.callback_data(f"rent_{service_key}_{network_code}", callback_rent, service_key, network_code)
+
+@router.callback('o', legacy='orders')
+def callback_orders(call, page):
+    answer_callback(call.id)
+    text, kb = render_orders(call.message.chat.id, int(page) if page.isdigit() else 0)
+    edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="HTML", reply_markup=kb)
+
+# ==================== UPDATE QUEUE ====================
+BUSY_TEXT = "⏳ Hệ thống đang bận, vui lòng thử lại sau giây lát"
+PROCESSING_TEXT = "⏳ Đang xử lý, vui lòng đợi"
+
+class UpdateQueue:
+    # Bounded queue with one FIFO per chat. Chats take turns one update at a
+    # time and a chat is never handled by two workers at once, so a single
+    # user hammering a button cannot starve the others or reorder itself.
+    def __init__(self, handle, workers=UPDATE_WORKERS, max_size=UPDATE_QUEUE_SIZE, chat_limit=UPDATE_CHAT_LIMIT):
+        self._handle = handle
+        self._workers = workers
+        self._max_size = max_size
+        self._chat_limit = chat_limit
+        self._chats = {}
+        self._ready = deque()
+        self._busy = set()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._started = False
+        self.shed = 0
+
+    def __len__(self):
+        return self._size
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self._workers):
+            threading.Thread(target=self._worker_loop, name=f"update-worker-{i}", daemon=True).start()
+
+    def put(self, chat_id, update):
+        self.start()
+        with self._cond:
+            pending = self._chats.get(chat_id)
+            if self._size >= self._max_size or (pending and len(pending) >= self._chat_limit):
+                self.shed += 1
+                metrics.inc("updates_shed_total")
+                return False
+            if pending is None:
+                pending = self._chats[chat_id] = deque()
+            pending.append((time.monotonic(), update))
+            self._size += 1
+            if len(pending) == 1 and chat_id not in self._busy:
+                self._ready.append(chat_id)
+                self._cond.notify()
+        return True
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                chat_id = self._ready.popleft()
+                queued_at, update = self._chats[chat_id].popleft()
+                self._size -= 1
+                self._busy.add(chat_id)
+            metrics.observe("update_wait_seconds", time.monotonic() - queued_at)
+            pending = None
+            try:
+                pending = self._handle(update)
+            except Exception as e:
+                logger.error("Update handler error: %s", e, extra={"chat_id": chat_id})
+            if pending is None:
+                self._done(chat_id)
+            else:
+                # The chat stays busy until the coroutine finishes, while
+                # this worker moves on to other chats.
+                pending.add_done_callback(lambda f, chat_id=chat_id: self._settle(chat_id, f))
+
+    def _settle(self, chat_id, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Update handler error: %s", future.exception(), extra={"chat_id": chat_id})
+        self._done(chat_id)
+
+    def _done(self, chat_id):
+        with self._cond:
+            self._busy.discard(chat_id)
+            if self._chats[chat_id]:
+                self._ready.append(chat_id)
+                self._cond.notify()
+            else:
+                del self._chats[chat_id]
+
+    def stats(self):
+        return {"depth": self._size, "chats": len(self._chats), "busy": len(self._busy), "shed": self.shed}
+
+def update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    return 0
+
+def busy_reply(update):
+    # Webhook replies can carry one Bot API call, so shedding costs no extra request.
+    if update.callback_query:
+        return {"method": "answerCallbackQuery", "callback_query_id": update.callback_query.id, "text": BUSY_TEXT}
+    if update.message:
+        return {"method": "sendMessage", "chat_id": update.message.chat.id, "text": BUSY_TEXT}
+    return None
+
+def tap_key(update):
+    call = update.callback_query
+    if call is None or call.message is None:
+        return None
+    return f"{call.message.chat.id}:{call.message.message_id}:{call.data}"
+
+def tap_owner(update):
+    # Per update, so a second copy of the tap is turned away even when it
+    # reaches the same worker.
+    return f"{WORKER_ID}:{update.update_id}"
+
+def release_tap(update):
+    if update.tap_key is not None:
+        state.release_slot(TAP_SLOTS, update.tap_key, tap_owner(update))
+
+def admit(update):
+    # Queues the update, or returns the one-call reply for turning it away:
+    # a repeat of a button tap that is still queued or running in any
+    # worker, or a full queue.
+    key = tap_key(update)
+    if key is not None and not state.take_slot(TAP_SLOTS, key, tap_owner(update), LEASE_TTL):
+        metrics.inc("taps_deduplicated_total")
+        return {"method": "answerCallbackQuery", "callback_query_id": update.callback_query.id,
+                "text": PROCESSING_TEXT}
+    update.tap_key = key
+    if update_queue.put(update_chat_id(update), update):
+        return None
+    release_tap(update)
+    return busy_reply(update)
+
+def handle_update(update):
+    # Webhook updates carry the trace started in the route; polled ones start it here.
+    # A handler that hands its I/O to the event loop returns the future, and
+    # the tap stays in flight until that settles.
+    pending = None
+    try:
+        with tracer.span("update", parent=getattr(update, 'trace', None), root=not hasattr(update, 'trace'),
+                         update_id=update.update_id, chat_id=update_chat_id(update)):
+            pending = router.dispatch(update)
+        return pending
+    finally:
+        if pending is None:
+            release_tap(update)
+        elif update.tap_key is not None:
+            # Settles on the event loop, which must not wait on SQLite.
+            pending.add_done_callback(lambda f: async_runtime.loop.run_in_executor(None, release_tap, update))
+
+update_queue = UpdateQueue(handle_update)
 
 # ==================== FLASK ROUTES ====================
-@app.route("/")
-def home():
-    html = f"""
+# The page is a static shell that fills its counters from /stats.json, so
+# uptime pings are answered from cache or with a 304.
+HOME_HTML = """
     <!DOCTYPE html>
     <html lang="vi">
     <head>
@@ -381,8 +2936,8 @@ def home():
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>OKVIP Bot</title>
         <style>
-            * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-            body {{
+            * { margin: 0; padding: 0; box-sizing: border-box; }
+            body {
                 font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                 background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
                 min-height: 100vh;
@@ -390,8 +2945,8 @@ def home():
                 align-items: center;
                 justify-content: center;
                 padding: 20px;
-            }}
-            .container {{
+            }
+            .container {
                 background: rgba(255, 255, 255, 0.95);
                 border-radius: 20px;
                 padding: 40px;
@@ -399,55 +2954,55 @@ def home():
                 width: 100%;
                 box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
                 text-align: center;
-            }}
-            h1 {{ 
+            }
+            h1 { 
                 color: #667eea; 
                 font-size: 2.5rem; 
                 margin-bottom: 10px;
                 text-shadow: 2px 2px 4px rgba(0,0,0,0.1);
-            }}
-            .subtitle {{
+            }
+            .subtitle {
                 color: #64748b;
                 font-size: 1.1rem;
                 margin-bottom: 30px;
-            }}
-            .stats {{
+            }
+            .stats {
                 display: grid;
                 grid-template-columns: repeat(2, 1fr);
                 gap: 20px;
                 margin: 30px 0;
-            }}
-            .stat {{
+            }
+            .stat {
                 background: linear-gradient(135deg, #f8fafc 0%, #e2e8f0 100%);
                 padding: 25px;
                 border-radius: 15px;
                 transition: transform 0.3s, box-shadow 0.3s;
-            }}
-            .stat:hover {{
+            }
+            .stat:hover {
                 transform: translateY(-5px);
                 box-shadow: 0 10px 25px rgba(0, 0, 0, 0.15);
-            }}
-            .stat-icon {{
+            }
+            .stat-icon {
                 font-size: 2.5rem;
                 margin-bottom: 10px;
-            }}
-            .stat-value {{ 
+            }
+            .stat-value { 
                 font-size: 2rem; 
                 font-weight: bold; 
                 color: #1e293b;
                 margin: 10px 0;
-            }}
-            .stat-label {{
+            }
+            .stat-label {
                 color: #64748b;
                 font-size: 0.9rem;
-            }}
-            .footer {{ 
+            }
+            .footer { 
                 margin-top: 30px; 
                 color: #64748b; 
                 font-size: 0.9rem;
                 line-height: 1.6;
-            }}
-            .status-badge {{
+            }
+            .status-badge {
                 display: inline-block;
                 background: #10b981;
                 color: white;
@@ -455,7 +3010,7 @@ def home():
                 border-radius: 20px;
                 font-weight: bold;
                 margin-top: 10px;
-            }}
+            }
         </style>
     </head>
     <body>
@@ -466,12 +3021,12 @@ def home():
             <div class="stats">
                 <div class="stat">
                     <div class="stat-icon">⏳</div>
-                    <div class="stat-value">{len(active_checks)}</div>
+                    <div class="stat-value" id="active-checks">-</div>
                     <div class="stat-label">Đang chờ OTP</div>
                 </div>
                 <div class="stat">
                     <div class="stat-icon">👥</div>
-                    <div class="stat-value">{len(user_orders)}</div>
+                    <div class="stat-value" id="total-users">-</div>
                     <div class="stat-label">Người dùng</div>
                 </div>
             </div>
@@ -479,41 +3034,159 @@ def home():
             <div class="status-badge">✅ ĐANG HOẠT ĐỘNG</div>
             
             <div class="footer">
-                ⏰ {datetime.now().strftime('%H:%M:%S - %d/%m/%Y')}<br>
+                ⏰ <span id="timestamp">-</span><br>
                 📱 Hỗ trợ 6 nhà mạng Việt Nam<br>
                 ⚡ Tự động nhận OTP trong 3-5 phút
             </div>
         </div>
+        <script>
+            function refresh() {
+                fetch('/stats.json', {cache: 'no-store'})
+                    .then(function (r) { return r.json(); })
+                    .then(function (s) {
+                        document.getElementById('active-checks').textContent = s.active_checks;
+                        document.getElementById('total-users').textContent = s.total_users;
+                        document.getElementById('timestamp').textContent = s.time;
+                    })
+                    .catch(function () {});
+            }
+            refresh();
+            setInterval(refresh, 15000);
+        </script>
     </body>
     </html>
     """
-    return html, 200
+HOME_ETAG = '"' + hashlib.sha1(HOME_HTML.encode('utf-8')).hexdigest()[:16] + '"'
+
+@app.route("/")
+def home():
+    if HOME_ETAG in request.headers.get("If-None-Match", ""):
+        response = Response(status=304)
+    else:
+        response = Response(HOME_HTML, mimetype="text/html")
+    response.headers["ETag"] = HOME_ETAG
+    response.headers["Cache-Control"] = "public, max-age=300"
+    return response
+
+stats_cache = {"at": 0.0, "body": None}
+
+@app.route("/stats.json")
+def stats_json():
+    now = time.monotonic()
+    if stats_cache["body"] is None or now - stats_cache["at"] > 2:
+        stats_cache["body"] = json.dumps({
+            "active_checks": state.active_count(),
+            "total_users": len(order_store),
+            "time": datetime.now().strftime('%H:%M:%S - %d/%m/%Y'),
+        })
+        stats_cache["at"] = now
+    response = Response(stats_cache["body"], mimetype="application/json")
+    response.headers["Cache-Control"] = "public, max-age=5"
+    return response
 
 @app.route("/health")
 def health():
     return jsonify({
         "status": "ok",
         "timestamp": datetime.now().isoformat(),
-        "active_checks": len(active_checks),
-        "total_users": len(user_orders),
+        "active_checks": state.active_count(),
+        "local_checks": len(otp_scheduler),
+        "worker": WORKER_ID,
+        "total_users": len(order_store),
+        "orders": order_store.stats(),
+        "log_dropped": log_handler.dropped,
+        "startup": startup_report(),
+        "otp_windows": poll_policy.stats(),
+        "otp_push": bool(OTP_CALLBACK_SECRET),
+        "reconcile": RECONCILE_ENDPOINT or None,
+        "balance": balance_cache.stats(),
+        "update_queue": update_queue.stats(),
+        "inflight_taps": state.slot_count(TAP_SLOTS),
+        "out_of_stock": stock_cache.stats(),
+        "http": http_pools.stats(),
+        "async": async_runtime.stats() if async_runtime is not None else None,
+        "breakers": {endpoint: breaker.info() for endpoint, breaker in list(breakers.items())},
         "bot": "OKVIP Bot",
         "version": "1.0"
     }), 200
 
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def callback_authorized(body):
+    signature = request.headers.get("X-Signature", "")
+    if signature:
+        expected = hmac.new(OTP_CALLBACK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature.removeprefix("sha256=").encode(), expected.encode())
+    token = request.headers.get("X-Callback-Token") or request.args.get("token", "")
+    return hmac.compare_digest(token.encode(), OTP_CALLBACK_SECRET.encode())
+
+@app.route(OTP_CALLBACK_PATH, methods=["POST"])
+def otp_callback():
+    if not OTP_CALLBACK_SECRET:
+        return jsonify({"ok": False}), 404
+    if not callback_authorized(request.get_data()):
+        metrics.inc("otp_push_total", outcome="unauthorized")
+        return jsonify({"ok": False}), 403
+    payload = request.get_json(silent=True) or request.form.to_dict()
+    data = (payload.get("data") or payload) if isinstance(payload, dict) else None
+    request_id = ""
+    if isinstance(data, dict):
+        request_id = str(data.get("RequestId") or data.get("requestId") or data.get("request_id") or "")
+    result = parse_session(data) if request_id else None
+    if result is None:
+        metrics.inc("otp_push_total", outcome="invalid")
+        return jsonify({"ok": False}), 400
+    if result.get("waiting"):
+        outcome = "waiting"
+    elif otp_scheduler.push(request_id, result):
+        outcome = "delivered"
+    else:
+        # Not pending here: another worker holds it or it was not resumed
+        # yet. An immediate poll picks the result up if we can take it.
+        order = order_store.get(request_id)
+        if order is not None and order.status == 'waiting' and otp_scheduler.schedule(pending_check(order), delay=0):
+            outcome = "polled"
+        else:
+            outcome = "unmatched"
+    metrics.inc("otp_push_total", outcome=outcome)
+    logger.info("OTP callback: %s", outcome, extra={"order_id": request_id})
+    return jsonify({"ok": True, "outcome": outcome})
+
+first_update_seen = threading.Event()
+
 @app.route(f"/{BOT_TOKEN}", methods=["POST"])
 def webhook():
     if USE_POLLING:
         return "OK", 200
     try:
         json_data = request.get_json()
-        if json_data:
-            update = telebot.types.Update.de_json(json_data)
-            bot.process_new_updates([update])
+        if json_data and wanted(json_data):
+            if not first_update_seen.is_set():
+                first_update_seen.set()
+                startup_mark("first_update")
+                logger.info("⏱️ First update %.2fs after boot", time.monotonic() - BOOT_STARTED)
+            with tracer.span("webhook", root=True) as span:
+                update = telebot.types.Update.de_json(json_data)
+                update.trace = span.context
+                reply = admit(update)
+                span.set(update_id=update.update_id, queued=reply is None)
+            if reply:
+                return jsonify(reply), 200
         return "OK", 200
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
+        logger.error("Webhook error: %s", e, extra={"sample_key": ("webhook",)})
         return "OK", 200
 
+resume_pending_orders()
+if state.shared:
+    threading.Thread(target=lease_reaper, name="lease-reaper", daemon=True).start()
+threading.Thread(target=http_pools.keepalive_loop, name="http-keepalive", daemon=True).start()
+if RECONCILE_ENDPOINT:
+    threading.Thread(target=reconciler, name="reconciler", daemon=True).start()
+startup_mark("init")
+
 # ==================== WEBHOOK SETUP ====================
 def setup_webhook():
     if USE_POLLING:
@@ -523,23 +3196,49 @@ def setup_webhook():
         if not WEBHOOK_URL:
             logger.error("❌ WEBHOOK_URL not set!")
             return
-        time.sleep(2)
-        bot.remove_webhook()
-        time.sleep(1)
         webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}"
-        result = bot.set_webhook(url=webhook_url, drop_pending_updates=True, max_connections=40)
-        if result:
-            logger.info(f"✅ Webhook set successfully: {webhook_url}")
+        # Only re-register when something changed, and never drop the
+        # updates Telegram queued while we were down.
+        info = bot.get_webhook_info()
+        if (info.url == webhook_url and info.max_connections == WEBHOOK_MAX_CONNECTIONS
+                and sorted(info.allowed_updates or ()) == sorted(ALLOWED_UPDATES)):
+            logger.info("✅ Webhook already set (%s pending updates)", info.pending_update_count)
+        elif bot.set_webhook(url=webhook_url, drop_pending_updates=False, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                             allowed_updates=ALLOWED_UPDATES):
+            logger.info("✅ Webhook set successfully: %s", webhook_url)
         else:
             logger.error("❌ Failed to set webhook")
     except Exception as e:
         logger.error(f"❌ Webhook setup error: {e}")
+    finally:
+        startup_mark("webhook")
+        logger.info("⏱️ Startup: %s", startup_report())
 
 def start_polling():
     logger.info("🔄 Starting polling mode...")
     bot.remove_webhook()
     time.sleep(1)
-    bot.infinity_polling(timeout=30, skip_pending=True)
+    skipped = bot.get_updates(offset=-1, timeout=0)
+    offset = skipped[-1].update_id + 1 if skipped else None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=30, long_polling_timeout=30,
+                                      allowed_updates=ALLOWED_UPDATES)
+        except Exception as e:
+            logger.error("Polling error: %s", e, extra={"sample_key": ("polling",)})
+            time.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            reply = admit(update)
+            if reply:
+                try:
+                    if update.callback_query:
+                        answer_callback(reply["callback_query_id"], reply["text"])
+                    else:
+                        send_message(reply["chat_id"], reply["text"])
+                except Exception as e:
+                    logger.error("Busy reply error: %s", e, extra={"sample_key": ("busy_reply",)})
 
 # ==================== MAIN ====================
 if __name__ == "__main__":